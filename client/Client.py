@@ -6,7 +6,7 @@ import asyncio
 import tkinter as tk
 import PySimpleGUI as sg
 from threading import Thread
-from .services.chats import send as chatSend, getAllUnreadMessages
+from .services.chats import send as chatSend, subscribe
 from .services.authentication import *
 from random import randint
 from tkinter import font
@@ -15,6 +15,9 @@ from PySimpleGUI.PySimpleGUI import Multiline
 usrName = ""
 chatPage = sg.Window("dummy")
 
+# How often, in seconds, the subscription to new messages is renewed
+SUBSCRIPTION_RENEWAL_TIME = 30
+
 
 async def main():
     #Runs the GUI main thread    
@@ -25,14 +28,15 @@ async def gui():
     #The main GUI thread. Responsible for creating, displaying and showing updates to the GUI.
     
     async def recieveMessages():
-        #Displays all unread messages by the user
+        #The server pushes new messages, which are handed to the GUI thread as events in
+        #the order they were posted. The subscription is renewed in case the server
+        #dropped it, and renewing it fetches the messages missed in the meantime.
         while True:
-            unreadChats = await getAllUnreadMessages()
-            for chat in unreadChats:
-                print(chat.toString())
-                chatPage['textbox'].update(
-                    chatPage['textbox'].get() + "\n" + chat.toString())
-                chatPage.refresh()
+            try:
+                await subscribe(lambda chat: chatPage.write_event_value('newChat', chat.toString()))
+            except Exception as error:
+                print("Could not subscribe to new messages", error)
+            await asyncio.sleep(SUBSCRIPTION_RENEWAL_TIME)
 
     def receiveMessagesBridge():
         asyncio.run(recieveMessages())
@@ -103,6 +107,10 @@ async def gui():
 
             if event == "Exit" or event == sg.WIN_CLOSED:
                 break
+            #Display new messages
+            if event == "newChat":
+                chatPage['textbox'].update(
+                    chatPage['textbox'].get() + "\n" + values['newChat'])
             #Send Messages
             if event == "Send":
                 chatMsg = values['msgInput']
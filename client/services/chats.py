@@ -1,68 +1,194 @@
 """This module allows the client to send and receive Chatter texts.
 
-   Chatter only supports a single chat room at the moment. This is called
-   the default chat room. This all messages can only be sent to that single
-   chat room.
+   Texts are posted to chat rooms. Every user is in the default chat room
+   once they log in, and can join and leave other rooms by their id. Texts
+   can only be sent to and received from the rooms the user is in.
 
    The routines in this module are thread safe and can be called from different
    threads.
 """
 
-from time import time
-from .messaging_protocol import send as msgSend
+import threading
+from typing import Callable
+from .messaging_protocol import send as msgSend, onPush, Response
 from .authentication import clientName
 
+# The room every user is in after logging in
+DEFAULT_ROOM = "default"
+
 
 class ChatMessage:
     """A ChatMessage stores the text of a message as well as the username of the user
-    that sent it.
+    that sent it and the room it was sent to.
 
     ChatMessages should not be confused with protocol messages.
     """
 
-    def __init__(self, sender: str, text: str) -> None:
+    def __init__(self, sender: str, text: str, room: str = DEFAULT_ROOM) -> None:
         self.sender = sender
         self.text = text
+        self.room = room
 
     def toString(self) -> str:
         return self.sender + ": " + self.text
 
 
-async def send(text: str) -> None:
-    """Sends the given text to the default chat room.
+async def join(room: str) -> None:
+    """Joins the chat room with the given id, so its texts can be sent and received.
 
     Throws error if authentication.login() has not been called.
     """
+    await msgSend("JOIN", {"room": room, "username": clientName["name"]})
+
+
+async def leave(room: str) -> None:
+    """Leaves the chat room with the given id.
+
+    Throws error if the user is not in the room.
+    """
+    with _subscriptionLock:
+        _subscriptions.pop(room, None)
+        _deliveredSeqs.pop(room, None)
+        _heldMessages.pop(room, None)
+    await msgSend("LEAVE", {"room": room, "username": clientName["name"]})
+
+
+async def send(text: str, room: str = DEFAULT_ROOM) -> None:
+    """Sends the given text to the given chat room.
+
+    Throws error if authentication.login() has not been called, or if the user
+    has not joined the room.
+    """
     print("name", clientName["name"])
-    await msgSend("MESSAGE", {"message": text, "username": clientName["name"]})
+    await msgSend("MESSAGE", {"message": text, "username": clientName["name"], "room": room})
+
 
+# How long, in seconds, the server holds a FETCH when there are no unread messages
+FETCH_WAIT = 20
+# Extra time for the response to a held FETCH to arrive
+FETCH_RESPONSE_TIMEOUT = 6
 
-_lastFetchTime = time()
+# The sequence id of the last message fetched from each room
+_lastSeqs: dict[str, int] = {}
 
 
-async def getAllUnreadMessages() -> list[ChatMessage]:
-    """Returns all the messages in the default chat room posted since the last time
-    this routine was called.
+async def getAllUnreadMessages(
+    room: str = DEFAULT_ROOM, wait: float = FETCH_WAIT
+) -> list[ChatMessage]:
+    """Returns all the messages in the given chat room posted since the last time
+    this routine was called for it.
 
     The messages are returned in the order they were sent by the other users.
 
-    This routine should be called periodically to ensure that the user sees the messages
-    as they are posted by the other users.
+    If there are no unread messages, the server holds the request for up to wait
+    seconds and responds as soon as one is posted, so calling this routine in a loop
+    shows the messages as they are posted without polling the server all the time.
+    An empty list is returned if nothing was posted in that time.
 
-    Throws error if authentication.login() has not been called.
+    Throws error if authentication.login() has not been called, or if the user
+    has not joined the room.
     """
-    global _lastFetchTime
-    messages: list[dict[str, str]] = await msgSend(
-        "FETCH", {"timestamp": _lastFetchTime, "username": clientName["name"]}
-    )
+    request = {"username": clientName["name"], "wait": wait, "room": room}
+    # The first time, the server sends the messages posted since the user joined the room
+    if room in _lastSeqs:
+        request["afterSeq"] = _lastSeqs[room]
+
+    response = await msgSend("FETCH", request, wait + FETCH_RESPONSE_TIMEOUT)
+    messages: list[dict[str, str]] = response["messages"]
 
-    if len(messages) > 0:
-        _lastFetchTime = time()
+    # Continue from the last message the server sent, so no message is skipped or
+    # fetched twice
+    _lastSeqs[room] = response["lastSeq"]
 
     out: list[ChatMessage] = []
     for msg in messages:
-        chatMessage = ChatMessage(sender=msg["username"], text=msg["message"])
+        chatMessage = ChatMessage(sender=msg["username"], text=msg["message"], room=room)
         print("RECEIVED message-> ", chatMessage.toString())
         out.append(chatMessage)
 
     return out
+
+
+# The callback given to subscribe() for each room
+_subscriptions: dict[str, Callable[[ChatMessage], None]] = {}
+# The sequence id of the last message handed to the callback of each room, once the
+# messages posted before the subscription have been fetched
+_deliveredSeqs: dict[str, int] = {}
+# Pushed messages waiting for the messages before them, by room and sequence id
+_heldMessages: dict[str, dict[int, ChatMessage]] = {}
+# Guards the subscription state above, which the thread receiving the pushes shares
+_subscriptionLock = threading.Lock()
+
+
+def _deliverHeldMessages(room: str, callback: Callable[[ChatMessage], None]) -> None:
+    """Hands the held messages that follow the last one delivered to the callback.
+
+    Must be called with _subscriptionLock held.
+    """
+    held = _heldMessages.get(room, {})
+    lastSeq = _deliveredSeqs.get(room)
+    if lastSeq == None:
+        return
+
+    for seq in [seq for seq in held if seq <= lastSeq]:
+        del held[seq]
+    while lastSeq + 1 in held:
+        lastSeq += 1
+        callback(held.pop(lastSeq))
+    _deliveredSeqs[room] = lastSeq
+
+
+def _onNewMessage(response: Response) -> None:
+    room = response.data.get("room", DEFAULT_ROOM)
+    with _subscriptionLock:
+        callback = _subscriptions.get(room)
+        if callback == None:
+            return
+
+        # Messages are delivered in sequence id order and only once. One that arrives
+        # after a missing one waits for it, which the next subscribe() fetches if the
+        # server dropped the subscription.
+        _heldMessages.setdefault(room, {})[response.data["seq"]] = ChatMessage(
+            sender=response.data["username"], text=response.data["message"], room=room
+        )
+        _deliverHeldMessages(room, callback)
+
+
+async def subscribe(callback: Callable[[ChatMessage], None], room: str = DEFAULT_ROOM) -> None:
+    """Has the server push the messages posted to the given chat room from now on.
+
+    The callback is called with each new message in the order they were posted, on the
+    thread that receives them, so it must be thread safe. After subscribing, the
+    messages missed since the last message delivered are fetched, so subscribing again
+    renews a subscription the server dropped because this client stopped answering
+    without losing any message.
+
+    Throws error if authentication.login() has not been called, or if the user
+    has not joined the room.
+    """
+    with _subscriptionLock:
+        _subscriptions[room] = callback
+        onPush(_onNewMessage)
+    await msgSend("SUBSCRIBE", {"username": clientName["name"], "room": room})
+
+    request = {"username": clientName["name"], "room": room}
+    # The first time, the server sends the messages the user has not fetched yet
+    with _subscriptionLock:
+        if room in _deliveredSeqs:
+            request["afterSeq"] = _deliveredSeqs[room]
+    response = await msgSend("FETCH", request)
+
+    with _subscriptionLock:
+        callback = _subscriptions.get(room)
+        if callback == None:
+            return
+
+        lastSeq = _deliveredSeqs.get(room)
+        for msg in response["messages"]:
+            if lastSeq == None or msg["seq"] > lastSeq:
+                lastSeq = msg["seq"]
+                callback(ChatMessage(sender=msg["username"], text=msg["message"], room=room))
+        if lastSeq == None or response["lastSeq"] > lastSeq:
+            lastSeq = response["lastSeq"]
+        _deliveredSeqs[room] = lastSeq
+        _deliverHeldMessages(room, callback)
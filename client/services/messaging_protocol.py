@@ -1,7 +1,7 @@
 """This module implements the client side of the messaging protocol for Chatter."""
 
 import json
-from typing import Any
+from typing import Any, Callable
 from ...protocol.rudp import Client
 
 # from protocol.rudp import Client
@@ -54,12 +54,27 @@ SERVER_NAME = "127.0.0.1"
 SERVER_PORT = 8000
 
 
-async def send(method: str, data: dict[str, Any]) -> Any:
+async def send(method: str, data: dict[str, Any], timeout: float = None) -> Any:
+    """Sends the request and returns the data of its response.
+
+    timeout is the number of seconds the response can take, and defaults to the
+    RUDP client's response timeout.
+    """
     request = Request(method, data)
-    requestId = client.send(request.toString().encode(), SERVER_NAME, SERVER_PORT)
+    requestId = await client.sendAsync(
+        request.toString().encode(), SERVER_NAME, SERVER_PORT, timeout
+    )
     print("request string", request.toString())
     responseString = (await client.response(requestId)).decode()
     response = _parseResponse(responseString)
     _throwIfResponseIsError(response)
 
     return response.data
+
+
+def onPush(callback: Callable[[Response], None]) -> None:
+    """Calls the callback with every message the server pushes to this client.
+
+    The callback runs on the thread that receives the pushes.
+    """
+    client.onPush(lambda message: callback(_parseResponse(message.decode())))
@@ -1,11 +1,14 @@
 """This module implements a method to compute a 16 bit hash of the given bytes."""
 
-import crc16
+import binascii
 
 
 def hash(data: bytes) -> bytes:
-    """Returns a two bytes hash code for the given data"""
-    checksum: int = crc16.crc16xmodem(data)
+    """Returns a two bytes hash code for the given data, which can be any bytes-like object
+
+    The hash is the CRC-16/XMODEM checksum of the data.
+    """
+    checksum: int = binascii.crc_hqx(data, 0)
     return checksum.to_bytes(2, 'big')
 
 
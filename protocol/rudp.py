@@ -4,26 +4,116 @@
    on top of UDP.
 """
 
-from time import time
+import asyncio
+import inspect
+import traceback
+from time import perf_counter, time
 
-from requests import delete
-from .udp import makeUDPSocket, readIncomingPacket, send as udpSend, serverListen
+from .udp import (
+    makeUDPSocket,
+    readIncomingPacket,
+    send as udpSend,
+    serverListen,
+    serverListenAsync,
+)
 from socket import socket
-from typing import Callable
-from asyncio import sleep as ftSleep
-from concurrent.futures import ThreadPoolExecutor
-from uuid import uuid4
+from typing import Awaitable, Callable, Union
+from collections import OrderedDict, deque
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from uuid import UUID, uuid4
+import heapq
+import struct
 import threading
+import zlib
 from .hashing import *
+from .tracing import Trace, currentTrace, resetTrace, span, startTrace
+
+# The version of the package format sent by this module
+PROTOCOL_VERSION = 1
+
+# The default number of seconds a client waits for the response to a request
+DEFAULT_RESPONSE_TIMEOUT = 6
+
+# Bounds of the retransmission timeout in seconds
+INITIAL_RTO = 0.5
+MIN_RTO = 0.05
+MAX_RTO = 4
+
+# How long, in seconds, the async server waits before acknowledging a request it has
+# not answered yet. Requests answered sooner are acknowledged by their response. It is
+# well under MIN_RTO, so the client does not retransmit in the meantime.
+ACK_DELAY = 0.01
+
+# The default number of times a package is sent before the client gives up on it
+MAX_SEND_ATTEMPTS = 8
+
+# Bounds of the number of packages a client has in flight to one server, which starts
+# at INITIAL_WINDOW and grows until packages are lost
+INITIAL_WINDOW = 10
+MIN_WINDOW = 2
+MAX_WINDOW = 1024
+
+# The maximum number of message bytes sent in one datagram. Bigger messages are
+# fragmented, which keeps datagrams within a typical 1500 byte MTU.
+MAX_FRAGMENT_SIZE = 1400
+# Small packages going to the same destination are packed together up to this many bytes
+MAX_DATAGRAM_SIZE = 1472
+MAX_FRAGMENT_COUNT = 0xFFFF
+
+# How long, in seconds, and how many bytes of incomplete fragmented messages are kept
+REASSEMBLY_TIMEOUT = 10
+REASSEMBLY_MAX_BYTES = 16 * 1024 * 1024
+
+# The number of pushed messages a client remembers, so that retransmitted pushes are not delivered twice
+PUSH_HISTORY_SIZE = 1024
+
+# Responses of at least this many bytes are compressed for clients that accept it, and
+# responses of at least COMPRESSION_EXECUTOR_THRESHOLD bytes are compressed on a worker
+# thread by AsyncServer, so the event loop is not held up
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_EXECUTOR_THRESHOLD = 16 * 1024
+COMPRESSION_LEVEL = 6
+
+# Preset dictionary of the compressed messages, made of the text that most responses of
+# the messaging protocol repeat. Clients and servers must use the same one.
+COMPRESSION_DICTIONARY = (
+    b"Status-name: NEW-MESSAGE\nStatus-message: New message\nData: "
+    b"Status-name: SUCCESS\nStatus-message: Successfully fetched messages\nData: "
+    b'{"messages": [{"seq": 1, "username": "", "room": "default", '
+    b'"timestamp": 1700000000.000000, "message": ""}, '
+    b'{"seq": 2, "username": "", "room": "default", '
+    b'"timestamp": 1700000000.000000, "message": ""}], "lastSeq": '
+)
+
+# How long, in seconds, and how many responses a server keeps to answer retransmitted requests
+REQUEST_BUFFER_MAX_AGE = 30
+REQUEST_BUFFER_MAX_ENTRIES = 100_000
+REQUEST_BUFFER_MAX_BYTES = 64 * 1024 * 1024
 
 
 class _Package:
-    def __init__(self, message: bytes, uuid: str) -> None:
+    def __init__(
+        self,
+        message: bytes,
+        uuid: bytes,
+        flags: int = 0,
+        fragmentIndex: int = 0,
+        fragmentCount: int = 1,
+        version: int = PROTOCOL_VERSION,
+    ) -> None:
         """Inits a package object.
 
-        uuid should be at least 36 characters long and only the first 36 characters should make the package unique"""
+        uuid is the 16 byte id of the request the package belongs to.
+
+        Messages too big for one datagram are sent as fragmentCount packages sharing the
+        same uuid. Packages of version 0 use the original format with a text uuid and
+        are only sent in reply to packages of that version."""
         self.message = message
         self.uuid = uuid
+        self.flags = flags
+        self.fragmentIndex = fragmentIndex
+        self.fragmentCount = fragmentCount
+        self.version = version
         pass
 
 
@@ -34,126 +124,1194 @@ class MalformedPackageError(Exception):
         )
 
 
+# Package flags
+# The package acknowledges the request, push or response with the same uuid. A server
+# acknowledges each request it receives unless it answers it straight away.
+_FLAG_ACK = 0x01
+_FLAG_FRAGMENT = 0x02
+_FLAG_COMPRESSED = 0x04
+# The package is a message a server sends without being asked, which the client acknowledges
+_FLAG_PUSH = 0x08
+# The package asks for the fragments of a message whose indices are packed in its
+# message. Servers send it as a selective ack of a fragmented request.
+_FLAG_RESEND = 0x10
+# The request comes from a client that can decompress the response
+_FLAG_ACCEPTS_COMPRESSION = 0x20
+# On a request, the client acknowledges responses that carry the flag. On a response,
+# the server resends it until the client acknowledges it.
+_FLAG_RELIABLE = 0x40
+
+# A package is laid out as: checksum (2 bytes), version, flags, message length (2 bytes),
+# uuid (16 bytes), then fragment index and count (2 bytes each) if it is a fragment,
+# then the message. The checksum covers everything after it.
+_HEADER = struct.Struct(">BBH16s")
+_FRAGMENT_HEADER = struct.Struct(">HH")
+
+# The byte after the checksum of a version 0 package is the first character of its text
+# uuid, which is a hex digit. The high bit of the version byte keeps the two apart.
+_UUID_CHARACTERS = b"0123456789abcdef"
+_VERSION_MARKER = 0x80
+
+
 def _packageToBytes(package: _Package) -> bytes:
     """Serialises the package to bytes to be sent over the protocol."""
-    dataSection = bytearray(package.uuid[0:36].encode())
-    dataSection += package.message
-    checksum = hash(bytes(dataSection))
+    if package.version == 0:
+        return _legacyPackageToBytes(package)
+
+    flags = package.flags
+    fragmentHeader = b""
+    if package.fragmentCount > 1:
+        flags |= _FLAG_FRAGMENT
+        fragmentHeader = _FRAGMENT_HEADER.pack(package.fragmentIndex, package.fragmentCount)
 
-    packageBytes = bytearray(checksum)
-    packageBytes += dataSection
-    return bytes(packageBytes)
+    dataSection = b"".join(
+        (
+            _HEADER.pack(
+                _VERSION_MARKER | package.version, flags, len(package.message), package.uuid
+            ),
+            fragmentHeader,
+            package.message,
+        )
+    )
+    return hash(dataSection) + dataSection
 
 
-def _packageFromBytes(data: bytes) -> _Package:
-    """Constructs a package object from the given bytes.
+def _packagesFromBytes(data: bytes) -> list[_Package]:
+    """Constructs the package objects carried by the given datagram.
 
-    Throws MalformedPackageError if the package is corrupted.
+    A datagram can hold several packages back to back. The messages of the packages
+    are views of data rather than copies.
+
+    Throws MalformedPackageError if the first package is corrupted. Packages after
+    a corrupted one are dropped, since their position can no longer be trusted.
     """
-    incomingChecksum = data[:2]
-    dataSection = data[2:]
-    computedChecksum = hash(dataSection)
+    view = memoryview(data)
+    if len(view) < 3:
+        raise MalformedPackageError()
 
-    incomingChecksumAsInt = int.from_bytes(incomingChecksum, "big")
-    computedChecksumAsInt = int.from_bytes(computedChecksum, "big")
+    if view[2] in _UUID_CHARACTERS:
+        return [_legacyPackageFromBytes(view)]
 
-    if incomingChecksumAsInt != computedChecksumAsInt:
+    packages: list[_Package] = []
+    offset = 0
+    while offset < len(view):
+        try:
+            package, offset = _readPackage(view, offset)
+        except MalformedPackageError:
+            if len(packages) == 0:
+                raise
+            break
+        packages.append(package)
+
+    return packages
+
+
+def _readPackage(view: memoryview, start: int) -> tuple[_Package, int]:
+    """Reads the package starting at the given offset and returns it with the offset of the next package."""
+    if len(view) < start + 2 + _HEADER.size:
         raise MalformedPackageError()
 
-    uuidStr = dataSection[:36].decode()
-    return _Package(dataSection[36:], uuidStr)
+    version, flags, length, uuid = _HEADER.unpack_from(view, start + 2)
+    if version != _VERSION_MARKER | PROTOCOL_VERSION:
+        raise MalformedPackageError()
+
+    offset = start + 2 + _HEADER.size
+    fragmentIndex, fragmentCount = 0, 1
+    if flags & _FLAG_FRAGMENT:
+        if len(view) < offset + _FRAGMENT_HEADER.size:
+            raise MalformedPackageError()
+        fragmentIndex, fragmentCount = _FRAGMENT_HEADER.unpack_from(view, offset)
+        offset += _FRAGMENT_HEADER.size
+        if fragmentIndex >= fragmentCount:
+            raise MalformedPackageError()
+
+    end = offset + length
+    if end > len(view) or hash(view[start + 2 : end]) != view[start : start + 2]:
+        raise MalformedPackageError()
+
+    package = _Package(
+        view[offset:end], uuid, flags & ~_FLAG_FRAGMENT, fragmentIndex, fragmentCount
+    )
+    return package, end
+
+
+def _coalescePackages(packagesInBytes: list[bytes]) -> list[bytes]:
+    """Packs the given packages into as few datagrams of at most MAX_DATAGRAM_SIZE bytes as possible.
+
+    Version 0 packages have no length field, so they are always sent on their own.
+    """
+    datagrams: list[bytes] = []
+    batch: list[bytes] = []
+    batchSize = 0
+    for packageInBytes in packagesInBytes:
+        if packageInBytes[2] in _UUID_CHARACTERS:
+            datagrams.append(packageInBytes)
+            continue
+
+        if batchSize + len(packageInBytes) > MAX_DATAGRAM_SIZE and len(batch) > 0:
+            datagrams.append(b"".join(batch))
+            batch = []
+            batchSize = 0
+        batch.append(packageInBytes)
+        batchSize += len(packageInBytes)
+
+    if len(batch) > 0:
+        datagrams.append(b"".join(batch))
+
+    return datagrams
+
+
+def _legacyPackageToBytes(package: _Package) -> bytes:
+    """Serialises the package in the version 0 format: checksum, text uuid, message."""
+    dataSection = str(UUID(bytes=package.uuid)).encode() + package.message
+    return hash(dataSection) + dataSection
+
+
+def _legacyPackageFromBytes(view: memoryview) -> _Package:
+    if hash(view[2:]) != view[:2]:
+        raise MalformedPackageError()
+
+    try:
+        uuid = UUID(bytes(view[2:38]).decode()).bytes
+    except ValueError:
+        raise MalformedPackageError()
+
+    return _Package(view[38:], uuid, version=0)
+
+
+def _packageToFragments(package: _Package, fragmentIndices: list[int] = None) -> list[bytes]:
+    """Splits the package into datagrams of at most MAX_FRAGMENT_SIZE message bytes each.
+
+    Only the fragments with the given indices are returned if fragmentIndices is set.
+    """
+    message = package.message
+    fragmentCount = max(1, -(-len(message) // MAX_FRAGMENT_SIZE))
+    if fragmentCount > MAX_FRAGMENT_COUNT:
+        raise ValueError(
+            f"A message of {len(message)} bytes is too big to be sent over RUDP."
+        )
+
+    # Version 0 peers cannot reassemble fragments
+    if fragmentCount == 1 or package.version == 0:
+        return [_packageToBytes(package)]
+
+    if fragmentIndices == None:
+        fragmentIndices = range(fragmentCount)
+
+    message = memoryview(message)
+    return [
+        _packageToBytes(
+            _Package(
+                message[i * MAX_FRAGMENT_SIZE : (i + 1) * MAX_FRAGMENT_SIZE],
+                package.uuid,
+                package.flags,
+                i,
+                fragmentCount,
+            )
+        )
+        for i in fragmentIndices
+        if i < fragmentCount
+    ]
+
+
+def _compress(message: bytes) -> bytes:
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=COMPRESSION_DICTIONARY)
+    return compressor.compress(message) + compressor.flush()
+
+
+def _decompress(message: bytes) -> bytes:
+    """Decompresses a message compressed by _compress.
+
+    Throws MalformedPackageError if the message is not a whole compressed message, or
+    if it would decompress to more than REASSEMBLY_MAX_BYTES.
+    """
+    decompressor = zlib.decompressobj(zdict=COMPRESSION_DICTIONARY)
+    try:
+        decompressed = decompressor.decompress(message, REASSEMBLY_MAX_BYTES)
+    except zlib.error:
+        raise MalformedPackageError()
+
+    if not decompressor.eof or len(decompressor.unconsumed_tail) > 0:
+        raise MalformedPackageError()
+
+    return decompressed
+
+
+def _makeResponse(request: _Package, responseMessage: bytes) -> _Package:
+    """Makes the package of the response to the request.
+
+    The message is compressed if the client accepts it and it is big enough to be
+    worth it, which is done before the package is split into fragments.
+    """
+    if (
+        request.flags & _FLAG_ACCEPTS_COMPRESSION
+        and len(responseMessage) >= COMPRESSION_THRESHOLD
+    ):
+        compressed = _compress(responseMessage)
+        if len(compressed) < len(responseMessage):
+            return _Package(compressed, request.uuid, _FLAG_COMPRESSED, version=request.version)
+
+    return _Package(responseMessage, request.uuid, version=request.version)
+
+
+def _makeResendRequest(uuid: bytes, fragmentIndices: list[int]) -> _Package:
+    """Makes a package asking for the given fragments of the message with the given id.
+
+    Clients ask for fragments of a response, and servers for fragments of a request.
+    """
+    fragmentIndices = fragmentIndices[: MAX_FRAGMENT_SIZE // 2]
+    return _Package(
+        struct.pack(f">{len(fragmentIndices)}H", *fragmentIndices), uuid, _FLAG_RESEND
+    )
+
+
+def _resendRequestFragments(package: _Package) -> list[int]:
+    """Returns the fragment indices asked for by a resend request."""
+    count = len(package.message) // 2
+    return list(struct.unpack_from(f">{count}H", package.message))
+
+
+class _PartialMessage:
+    """The fragments of a message received so far."""
+
+    def __init__(self, fragmentCount: int) -> None:
+        self.fragments: list[bytes] = [None] * fragmentCount
+        self.received = 0
+        self.size = 0
+        self.updatedAt = time()
+
+    def missingFragments(self) -> list[int]:
+        return [i for i, fragment in enumerate(self.fragments) if fragment == None]
+
+
+class _ReassemblyBuffer:
+    """Puts fragmented messages back together.
+
+    Messages that have not received a fragment for timeout seconds are dropped, as are
+    the least recently updated messages when the buffer holds more than maxBytes bytes.
+    """
+
+    def __init__(
+        self, timeout: float = REASSEMBLY_TIMEOUT, maxBytes: int = REASSEMBLY_MAX_BYTES
+    ) -> None:
+        self.timeout = timeout
+        self.maxBytes = maxBytes
+        self.messages: OrderedDict[bytes, _PartialMessage] = OrderedDict()
+        self.totalBytes = 0
+
+        self.fragments = 0
+        self.reassembled = 0
+        self.dropped = 0
+
+    def add(self, package: _Package) -> bytes:
+        """Adds the fragment to its message and returns the whole message once every fragment has arrived.
+
+        Packages that are not fragmented are returned as is.
+        """
+        if package.fragmentCount == 1:
+            return bytes(package.message)
+
+        self.expire()
+        self.fragments += 1
+
+        partial = self.messages.get(package.uuid)
+        if partial == None:
+            partial = _PartialMessage(package.fragmentCount)
+            self.messages[package.uuid] = partial
+        elif len(partial.fragments) != package.fragmentCount:
+            return None
+
+        if partial.fragments[package.fragmentIndex] == None:
+            partial.fragments[package.fragmentIndex] = package.message
+            partial.received += 1
+            partial.size += len(package.message)
+            self.totalBytes += len(package.message)
+
+        partial.updatedAt = time()
+        self.messages.move_to_end(package.uuid)
+
+        if partial.received == len(partial.fragments):
+            self.discard(package.uuid)
+            self.reassembled += 1
+            return b"".join(partial.fragments)
+
+        while self.totalBytes > self.maxBytes and len(self.messages) > 1:
+            self.discard(next(iter(self.messages)))
+            self.dropped += 1
+
+        return None
+
+    def missingFragments(self, uuid: bytes) -> list[int]:
+        """Returns the indices of the fragments still missing from the message, or None if none have arrived."""
+        partial = self.messages.get(uuid)
+        if partial == None:
+            return None
+        return partial.missingFragments()
+
+    def discard(self, uuid: bytes) -> None:
+        partial = self.messages.pop(uuid, None)
+        if partial != None:
+            self.totalBytes -= partial.size
+
+    def expire(self, now: float = None) -> None:
+        """Drops the messages that have not been updated for timeout seconds."""
+        if now == None:
+            now = time()
+
+        while len(self.messages) > 0:
+            uuid, oldest = next(iter(self.messages.items()))
+            if now - oldest.updatedAt < self.timeout:
+                break
+            self.discard(uuid)
+            self.dropped += 1
+
+
+class DeliveryFailedError(Exception):
+    def __init__(self, toHostname: str, toPort: int, attempts: int) -> None:
+        super().__init__(
+            f"No response was received from {toHostname}:{toPort} after sending the package {attempts} times."
+        )
 
 
 class _PackageSendRequest:
-    """A struct of the parameters required to send packages to a server."""
+    """A struct of the parameters required to send packages to a server.
+
+    packagesInBytes holds more than one package when the message is fragmented.
+    """
 
-    def __init__(self, packageInBytes: bytes, toHostname: str, toPort: int) -> None:
-        self.packageInBytes = packageInBytes
+    def __init__(
+        self, packagesInBytes: list[bytes], toHostname: str, toPort: int
+    ) -> None:
+        self.packagesInBytes = packagesInBytes
         self.toHostname = toHostname
         self.toPort = toPort
+        self.attempts = 0
+        self.sentAt = 0.0
+        self.retransmitAt = 0.0
+        self.isResponseArriving = False
+        # Whether the packages count towards the send window of the server, from when
+        # they are first sent until the server acknowledges them
+        self.isInFlight = False
+        # Resolved when the request leaves the queue of the send window, for sendAsync
+        self.sentFuture: Future = None
+        # Whether an ack or response from the server has arrived
+        self.isAcknowledged = False
+        # Indices of the fragments the server said it is missing in its last selective ack
+        self.missingFragments: list[int] = None
         pass
 
+    def fragmentsToResend(self) -> list[bytes]:
+        """The fragments the server is missing, with the last fragment, whose arrival makes the server send its next selective ack."""
+        lastIndex = len(self.packagesInBytes) - 1
+        indices = [i for i in self.missingFragments if i < lastIndex] + [lastIndex]
+        return [self.packagesInBytes[i] for i in indices]
+
+
+class _RttEstimator:
+    """Estimates the round trip time and retransmission timeout of a destination.
+
+    Uses the Jacobson/Karels algorithm from RFC 6298.
+    """
+
+    def __init__(self) -> None:
+        self.srtt: float = None
+        self.rttvar: float = None
+        self.rto = INITIAL_RTO
+
+    def addSample(self, rtt: float) -> None:
+        """Updates the estimate with the round trip time of a package that was sent only once."""
+        if self.srtt == None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+
+class _SendWindow:
+    """Limits the number of packages in flight to a destination, like TCP congestion control.
+
+    A package is in flight from when it is first sent until the server acknowledges or
+    answers its request. The window starts with slow start, growing by a package for
+    every package acknowledged, and from ssthresh on grows by one package per window
+    acknowledged. A lost package halves it, at most once per retransmission timeout,
+    since the packages sent together are often lost together (AIMD). Requests that do
+    not fit in the window wait in the queue.
+    """
 
-class Client:
     def __init__(self) -> None:
-        self.buffer: dict[str, _PackageSendRequest] = {}
-        self.responses: dict[str, bytes] = {}
+        self.cwnd: float = INITIAL_WINDOW
+        self.ssthresh: float = MAX_WINDOW
+        self.inFlight = 0
+        # Ids of the requests waiting to be sent, in the order they were sent
+        self.queue: deque[bytes] = deque()
+        self.lastDecreaseAt = 0.0
+
+    def canSend(self, packageCount: int) -> bool:
+        """Whether a request of the given number of packages fits in the window.
+
+        A request that is bigger than the whole window is sent when nothing else is in flight.
+        """
+        return self.inFlight == 0 or self.inFlight + packageCount <= self.cwnd
+
+    def onAcknowledged(self, packageCount: int) -> None:
+        if self.cwnd < self.ssthresh:
+            self.cwnd += packageCount
+        else:
+            self.cwnd += packageCount / self.cwnd
+        self.cwnd = min(self.cwnd, MAX_WINDOW)
+
+    def onLoss(self, now: float, rto: float) -> None:
+        if now - self.lastDecreaseAt < rto:
+            return
+
+        self.ssthresh = max(self.cwnd / 2, MIN_WINDOW)
+        self.cwnd = self.ssthresh
+        self.lastDecreaseAt = now
+
+
+class _PendingResponse:
+    """Holds the future that the receiving thread resolves with the response to a request."""
+
+    def __init__(self, deadline: float) -> None:
+        self.future: Future = Future()
+        self.deadline = deadline
+
+
+class Client:
+    def __init__(
+        self,
+        responseTimeout: float = DEFAULT_RESPONSE_TIMEOUT,
+        maxAttempts: int = MAX_SEND_ATTEMPTS,
+        acceptCompression: bool = True,
+    ) -> None:
+        """Inits the client.
+
+        With acceptCompression, the client tells servers that they can compress big
+        responses, which it decompresses before they are returned.
+        """
+        self.buffer: dict[bytes, _PackageSendRequest] = {}
+        self.responses: dict[bytes, _PendingResponse] = {}
+        self.responseTimeout = responseTimeout
+        self.maxAttempts = maxAttempts
+        self.requestFlags = _FLAG_RELIABLE
+        if acceptCompression:
+            self.requestFlags |= _FLAG_ACCEPTS_COMPRESSION
+        self.rttEstimators: dict[tuple[str, int], _RttEstimator] = {}
+        self.sendWindows: dict[tuple[str, int], _SendWindow] = {}
+        # Heap of (retransmitAt, requestId) for the packages in the buffer
+        self.retransmitQueue: list[tuple[float, bytes]] = []
+        self.reassemblyBuffer = _ReassemblyBuffer()
+        # Packages waiting to be sent for the first time
+        self.outbox: list[_PackageSendRequest] = []
+        # Ids of the last PUSH_HISTORY_SIZE pushes received
+        self.receivedPushes: OrderedDict[bytes, None] = OrderedDict()
+        self.onPushCallback: Callable[[bytes], None] = None
+        self.retransmits = 0
+        self.resendRequests = 0
+        self.malformedPackages = 0
+        self.losses = 0
+        self.selectiveAcks = 0
+        # Guards the state above, which is shared with the receiving and sending threads
+        self.lock = threading.Condition()
 
-        self.pushTimer: threading.Timer = None
         self.channel: socket = makeUDPSocket()
 
         # with ThreadPoolExecutor() as executor:
         ThreadPoolExecutor().submit(self._pollResponses)
+        threading.Thread(target=self._pushPackages, daemon=True).start()
 
-    def send(self, message: bytes, toHostname: str, toPort: int) -> str:
+    def send(
+        self, message: bytes, toHostname: str, toPort: int, timeout: float = None
+    ) -> bytes:
         """Sends the given message to the server with the given hostname and port.
 
         The hostname can be an IP address.
 
+        timeout is the number of seconds the response can take to arrive and
+        defaults to the client's responseTimeout.
+
         The return value is the id of the request, which can be used to get its
         response.
+
+        If the send window of the server is full, the request waits in a queue
+        until there is room for it. Use sendAsync to wait until it has left the queue.
         """
-        package = _Package(message, str(uuid4()))
-        self.buffer[package.uuid] = _PackageSendRequest(
-            _packageToBytes(package), toHostname, toPort
-        )
+        if timeout == None:
+            timeout = self.responseTimeout
 
-        if self.pushTimer == None:
-            self.pushTimer = threading.Timer(0.5, self._pushPackagesToServer).start()
+        package = _Package(message, uuid4().bytes, self.requestFlags)
+        request = _PackageSendRequest(_packageToFragments(package), toHostname, toPort)
+        with self.lock:
+            self.buffer[package.uuid] = request
+            self.responses[package.uuid] = _PendingResponse(time() + timeout)
+            window = self._sendWindow(toHostname, toPort)
+            if len(window.queue) == 0 and window.canSend(len(request.packagesInBytes)):
+                self._sendFirst(package.uuid, request, window)
+            else:
+                window.queue.append(package.uuid)
 
         return package.uuid
 
-    async def response(self, requestId: str) -> bytes:
-        """Gets the response for the request with the given id."""
-        return await self._response(requestId, time())
+    async def sendAsync(
+        self, message: bytes, toHostname: str, toPort: int, timeout: float = None
+    ) -> bytes:
+        """Sends the message like send, returning once the request has left the queue of the send window.
+
+        Callers sending many requests are held back this way, instead of queueing
+        requests faster than the server takes them.
+        """
+        requestId = self.send(message, toHostname, toPort, timeout)
+        with self.lock:
+            request = self.buffer.get(requestId)
+            # Requests sent straight away have been scheduled already
+            if request == None or request.attempts > 0:
+                return requestId
+            request.sentFuture = Future()
+
+        await asyncio.wrap_future(request.sentFuture)
+        return requestId
 
-    async def _response(self, requestId: str, pollStartTime) -> bytes:
-        """Gets the response for the request with the given id."""
-        if time() - pollStartTime > 6:
+    async def response(self, requestId: bytes) -> bytes:
+        """Gets the response for the request with the given id.
+
+        The caller is woken up as soon as the response arrives. Raises TimeoutError
+        if it does not arrive before the request's deadline, DeliveryFailedError if
+        the server did not answer any of the retransmissions, and CancelledError if
+        the request is cancelled while waiting.
+        """
+        pending = self.responses.get(requestId)
+        if pending == None:
+            raise KeyError(f"No request with id {requestId.hex()} is awaiting a response")
+
+        try:
+            return await asyncio.wait_for(
+                asyncio.wrap_future(pending.future), max(pending.deadline - time(), 0)
+            )
+        except asyncio.TimeoutError:
             raise TimeoutError()
+        finally:
+            self.cancel(requestId)
 
-        if self.responses.get(requestId) != None:
-            responseData = self.responses[requestId]
-            del self.responses[requestId]
-            return responseData
+    def onPush(self, callback: Callable[[bytes], None]) -> None:
+        """Sets the function called with the message of every push received from a server.
 
-        await ftSleep(0.5)
-        return await self._response(requestId, pollStartTime)
+        Each push is acknowledged and passed to the callback once, even if the server
+        sends it again. The callback runs on the receiving thread.
+        """
+        self.onPushCallback = callback
+
+    def cancel(self, requestId: bytes) -> None:
+        """Stops sending the request with the given id and drops its response."""
+        with self.lock:
+            request = self.buffer.pop(requestId, None)
+            if request != None:
+                self._leaveWindow(request)
+                self._resolveSentFuture(request)
+            self.reassemblyBuffer.discard(requestId)
+            pending = self.responses.pop(requestId, None)
+
+        if pending != None:
+            pending.future.cancel()
+
+    def _rttEstimator(self, toHostname: str, toPort: int) -> _RttEstimator:
+        estimator = self.rttEstimators.get((toHostname, toPort))
+        if estimator == None:
+            estimator = _RttEstimator()
+            self.rttEstimators[(toHostname, toPort)] = estimator
+        return estimator
+
+    def _sendWindow(self, toHostname: str, toPort: int) -> _SendWindow:
+        window = self.sendWindows.get((toHostname, toPort))
+        if window == None:
+            window = _SendWindow()
+            self.sendWindows[(toHostname, toPort)] = window
+        return window
+
+    def _sendFirst(self, requestId: bytes, request: _PackageSendRequest, window: _SendWindow) -> None:
+        """Puts the request in flight and hands it to the sending thread.
+
+        Must be called with the lock held.
+        """
+        request.isInFlight = True
+        window.inFlight += len(request.packagesInBytes)
+        self._schedule(requestId, request)
+        # The sending thread packs requests made in quick succession into shared datagrams
+        self.outbox.append(request)
+        self.lock.notify()
+        self._resolveSentFuture(request)
+
+    def _resolveSentFuture(self, request: _PackageSendRequest) -> None:
+        if request.sentFuture == None:
+            return
+
+        try:
+            request.sentFuture.set_result(None)
+        except InvalidStateError:
+            # The sendAsync call was cancelled
+            pass
+
+    def _leaveWindow(self, request: _PackageSendRequest, isAcknowledged: bool = False) -> None:
+        """Takes the packages of the request out of flight, sending the queued requests that now fit.
+
+        Only acknowledged packages grow the window. Must be called with the lock held.
+        """
+        if not request.isInFlight:
+            return
+
+        request.isInFlight = False
+        packageCount = len(request.packagesInBytes)
+        window = self._sendWindow(request.toHostname, request.toPort)
+        window.inFlight -= packageCount
+        if isAcknowledged:
+            window.onAcknowledged(packageCount)
+
+        while len(window.queue) > 0:
+            queuedRequest = self.buffer.get(window.queue[0])
+            # Requests cancelled while queued are skipped
+            if queuedRequest != None and not window.canSend(len(queuedRequest.packagesInBytes)):
+                break
+            requestId = window.queue.popleft()
+            if queuedRequest != None:
+                self._sendFirst(requestId, queuedRequest, window)
 
-    def _pushPackagesToServer(self):
-        """Runs through all the packages in the buffer and sends them all to their destination servers."""
-        for _, request in self.buffer.items():
-            udpSend(
-                request.packageInBytes, request.toHostname, request.toPort, self.channel
+    def _schedule(self, requestId: bytes, request: _PackageSendRequest) -> None:
+        """Records a (re)transmission of the request and queues its next one.
+
+        Each retransmission waits twice as long as the previous one, up to MAX_RTO.
+        Must be called with the lock held.
+        """
+        now = time()
+        rto = self._rttEstimator(request.toHostname, request.toPort).rto
+        request.sentAt = now
+        request.retransmitAt = now + min(rto * 2**request.attempts, MAX_RTO)
+        request.attempts += 1
+        heapq.heappush(self.retransmitQueue, (request.retransmitAt, requestId))
+
+    def _acknowledge(self, request: _PackageSendRequest) -> None:
+        """Records that the server has the request, on the first ack or response to it.
+
+        The round trip time is measured up to the first of these, so with the server
+        acknowledging slow requests straight away, it does not include how long the
+        request takes to handle. Must be called with the lock held.
+        """
+        if request.isAcknowledged:
+            return
+
+        request.isAcknowledged = True
+        # Karn's algorithm: the round trip time of a retransmitted package is ambiguous
+        if request.attempts == 1:
+            self._rttEstimator(request.toHostname, request.toPort).addSample(
+                time() - request.sentAt
+            )
+        # The server has the request, so its packages are no longer in flight
+        self._leaveWindow(request, isAcknowledged=True)
+
+    def _resendFragments(
+        self, requestId: bytes, request: _PackageSendRequest, fragmentIndices: list[int]
+    ) -> None:
+        """Sends the fragments of the request that a selective ack from the server says are missing.
+
+        Must be called with the lock held.
+        """
+        if request.isAcknowledged or len(fragmentIndices) == 0:
+            return
+
+        self.selectiveAcks += 1
+        self.losses += 1
+        self._sendWindow(request.toHostname, request.toPort).onLoss(
+            time(), self._rttEstimator(request.toHostname, request.toPort).rto
+        )
+
+        # The backoff starts over as long as fewer fragments are missing each time
+        isProgress = request.missingFragments == None or len(fragmentIndices) < len(
+            request.missingFragments
+        )
+        request.missingFragments = fragmentIndices
+        if isProgress:
+            self._postpone(requestId, request)
+        else:
+            self._schedule(requestId, request)
+
+        self.outbox.append(
+            _PackageSendRequest(request.fragmentsToResend(), request.toHostname, request.toPort)
+        )
+        self.lock.notify()
+
+    def _postpone(self, requestId: bytes, request: _PackageSendRequest) -> None:
+        """Pushes back the next retransmission of a request whose response is arriving.
+
+        The backoff starts over, so that the client only gives up on a request after
+        maxAttempts retransmissions in a row brought no new fragments.
+        Must be called with the lock held.
+        """
+        rto = self._rttEstimator(request.toHostname, request.toPort).rto
+        request.attempts = 1
+        request.retransmitAt = time() + rto
+        heapq.heappush(self.retransmitQueue, (request.retransmitAt, requestId))
+
+    def _awaitHandling(self, requestId: bytes, request: _PackageSendRequest) -> None:
+        """Pushes back the next retransmission of a request the server is still handling.
+
+        Requests can be held by the server for a long time, e.g. until there is something
+        new to respond with. They are only retransmitted every MAX_RTO seconds meanwhile,
+        which the server acknowledges again, so the client still notices if it goes away.
+        Must be called with the lock held.
+        """
+        request.attempts = 1
+        request.retransmitAt = time() + MAX_RTO
+        heapq.heappush(self.retransmitQueue, (request.retransmitAt, requestId))
+
+    def _pushPackages(self):
+        """Sends new packages and resends the packages whose responses are late, until they run out of attempts."""
+        while True:
+            with self.lock:
+                toSend = self.outbox
+                self.outbox = []
+                failed: list[tuple[bytes, _PackageSendRequest]] = []
+                now = time()
+                while len(self.retransmitQueue) > 0 and self.retransmitQueue[0][0] <= now:
+                    retransmitAt, requestId = heapq.heappop(self.retransmitQueue)
+                    request = self.buffer.get(requestId)
+                    # Entries of fulfilled or rescheduled requests are stale
+                    if request == None or request.retransmitAt != retransmitAt:
+                        continue
+
+                    if request.attempts >= self.maxAttempts:
+                        del self.buffer[requestId]
+                        self._leaveWindow(request)
+                        self.reassemblyBuffer.discard(requestId)
+                        failed.append((requestId, request))
+                        continue
+
+                    # Neither an acknowledgement nor a response arrived in time
+                    if request.isInFlight:
+                        self.losses += 1
+                        self._sendWindow(request.toHostname, request.toPort).onLoss(
+                            now, self._rttEstimator(request.toHostname, request.toPort).rto
+                        )
+
+                    self._schedule(requestId, request)
+
+                    # Once part of the response has arrived, only its missing fragments are asked for
+                    missingFragments = self.reassemblyBuffer.missingFragments(requestId)
+                    if missingFragments == None and request.missingFragments != None:
+                        # Only the fragments of the request the server said it is missing are resent
+                        self.retransmits += 1
+                        toSend.append(
+                            _PackageSendRequest(
+                                request.fragmentsToResend(), request.toHostname, request.toPort
+                            )
+                        )
+                    elif missingFragments == None:
+                        self.retransmits += 1
+                        toSend.append(request)
+                    else:
+                        self.resendRequests += 1
+                        resendRequest = _makeResendRequest(requestId, missingFragments)
+                        toSend.append(
+                            _PackageSendRequest(
+                                [_packageToBytes(resendRequest)],
+                                request.toHostname,
+                                request.toPort,
+                            )
+                        )
+
+                if len(toSend) == 0 and len(failed) == 0:
+                    timeout = None
+                    if len(self.retransmitQueue) > 0:
+                        timeout = self.retransmitQueue[0][0] - now
+                    self.lock.wait(timeout)
+                    continue
+
+                pendingResponses = [
+                    (self.responses.get(requestId), request) for requestId, request in failed
+                ]
+
+            self._pushPackagesToServer(toSend)
+            for pending, request in pendingResponses:
+                if pending != None:
+                    self._failPendingResponse(pending, request)
+
+    def _failPendingResponse(
+        self, pending: _PendingResponse, request: _PackageSendRequest
+    ) -> None:
+        try:
+            pending.future.set_exception(
+                DeliveryFailedError(request.toHostname, request.toPort, request.attempts)
+            )
+        except InvalidStateError:
+            pass
+
+    def _pushPackagesToServer(self, requests: list[_PackageSendRequest]):
+        """Sends the given packages to their destination servers.
+
+        Packages going to the same server are packed into as few datagrams as possible.
+        """
+        byDestination: dict[tuple[str, int], list[bytes]] = {}
+        for request in requests:
+            byDestination.setdefault((request.toHostname, request.toPort), []).extend(
+                request.packagesInBytes
             )
 
+        for (toHostname, toPort), packagesInBytes in byDestination.items():
+            for datagram in _coalescePackages(packagesInBytes):
+                udpSend(datagram, toHostname, toPort, self.channel)
+
     def _pollResponses(self):
         while True:
-            packageBytes, (_, __) = readIncomingPacket(self.channel)
+            packageBytes, address = readIncomingPacket(self.channel)
             try:
-                package = _packageFromBytes(packageBytes)
+                packages = _packagesFromBytes(packageBytes)
             except MalformedPackageError:
+                self.malformedPackages += 1
                 continue
 
+            for package in packages:
+                if package.flags & _FLAG_PUSH:
+                    self._receivePush(package, address)
+                else:
+                    self._receivePackage(package, address)
+
+    def _receivePush(self, package: _Package, address: tuple[str, int]) -> None:
+        with self.lock:
+            message = self.reassemblyBuffer.add(package)
+            if message == None:
+                return
+
+            isNew = package.uuid not in self.receivedPushes
+            if isNew:
+                self.receivedPushes[package.uuid] = None
+                if len(self.receivedPushes) > PUSH_HISTORY_SIZE:
+                    self.receivedPushes.popitem(last=False)
+
+        # Retransmitted pushes are acknowledged again, in case the first ack was lost
+        self._sendAck(package.uuid, address)
+
+        if isNew and self.onPushCallback != None:
+            try:
+                self.onPushCallback(message)
+            except Exception:
+                traceback.print_exc()
+
+    def _sendAck(self, uuid: bytes, address: tuple[str, int]) -> None:
+        ack = _Package(b"", uuid, _FLAG_ACK)
+        udpSend(_packageToBytes(ack), address[0], address[1], self.channel)
+
+    def _receivePackage(self, package: _Package, address: tuple[str, int]) -> None:
+        with self.lock:
+            request = self.buffer.get(package.uuid)
+            if request == None:
+                # Responses to requests that timed out, were cancelled or were already
+                # answered are dropped. Resent responses are acknowledged again, once per
+                # pass over their fragments, in case the first ack was lost.
+                if (
+                    package.flags & _FLAG_RELIABLE
+                    and package.fragmentIndex == package.fragmentCount - 1
+                ):
+                    self._sendAck(package.uuid, address)
+                return
+
+            if package.flags & _FLAG_RESEND:
+                self._resendFragments(package.uuid, request, _resendRequestFragments(package))
+                return
+
+            self._acknowledge(request)
+
+            if package.flags & _FLAG_ACK:
+                if not request.isResponseArriving:
+                    self._awaitHandling(package.uuid, request)
+                return
+
+            request.isResponseArriving = True
+
+            message = self.reassemblyBuffer.add(package)
+            if message == None:
+                self._postpone(package.uuid, request)
+                return
+
             del self.buffer[package.uuid]  # request has been fulfilled
-            self.responses[package.uuid] = package.message
+            pending = self.responses.get(package.uuid)
+
+        if package.flags & _FLAG_RELIABLE:
+            self._sendAck(package.uuid, address)
+
+        if pending == None:
+            return
+
+        try:
+            if package.flags & _FLAG_COMPRESSED:
+                try:
+                    message = _decompress(message)
+                except MalformedPackageError as error:
+                    pending.future.set_exception(error)
+                    return
+
+            pending.future.set_result(message)
+        except InvalidStateError:
+            pass
 
 
 class _RequestBufferItem:
     def __init__(
-        self, request: _Package, response: _Package, createdAt: float = time()
+        self, request: _Package, response: _Package, createdAt: float = None
     ) -> None:
         self.request = request
-        self.createdAt = createdAt
+        self.createdAt = time() if createdAt == None else createdAt
         self.response = response
 
+    def size(self) -> int:
+        """The number of message bytes held by the item."""
+        return len(self.request.message) + len(self.response.message)
+
+
+class _RequestBuffer:
+    """Remembers the responses to recent requests, so that retransmitted requests are not handled twice.
+
+    Items are kept in the order they were added, which is also the order in which
+    they expire, so expiring old items only ever looks at the oldest ones. When the
+    buffer holds more than maxEntries items or maxBytes message bytes, the oldest
+    items are evicted early.
+    """
+
+    def __init__(
+        self,
+        maxAge: float = REQUEST_BUFFER_MAX_AGE,
+        maxEntries: int = REQUEST_BUFFER_MAX_ENTRIES,
+        maxBytes: int = REQUEST_BUFFER_MAX_BYTES,
+    ) -> None:
+        self.maxAge = maxAge
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.items: OrderedDict[bytes, _RequestBufferItem] = OrderedDict()
+        self.totalBytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, requestId: bytes) -> _RequestBufferItem:
+        """Returns the item of the request with the given id, or None if it is not buffered."""
+        item = self.items.get(requestId)
+        if item == None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return item
+
+    def add(self, requestId: bytes, item: _RequestBufferItem) -> None:
+        old = self.items.pop(requestId, None)
+        if old != None:
+            self.totalBytes -= old.size()
+
+        self.items[requestId] = item
+        self.totalBytes += item.size()
+
+        while len(self.items) > self.maxEntries or (
+            self.totalBytes > self.maxBytes and len(self.items) > 1
+        ):
+            self._popOldest()
+            self.evictions += 1
+
+    def expire(self, now: float = None) -> None:
+        """Deletes all items older than maxAge seconds."""
+        if now == None:
+            now = time()
+
+        while len(self.items) > 0:
+            oldest = next(iter(self.items.values()))
+            if now - oldest.createdAt < self.maxAge:
+                break
+            self._popOldest()
+
+    def _popOldest(self) -> None:
+        _, item = self.items.popitem(last=False)
+        self.totalBytes -= item.size()
+
+
+class _BaseServer:
+    """The parts of an RUDP server that do not depend on how it does I/O.
+
+    Subclasses deliver incoming datagrams to _receiveDatagram, implement _sendDatagram
+    and call _flushOutbox to send the packages queued for each client.
+    """
 
-class Server:
     def __init__(self, port: int) -> None:
         self.port = port
         self.onMessageCallback = None
+        # Given the trace of each request once it is answered, while requests are traced
+        self.onTraceCallback: Callable[[Trace], None] = None
+        self.requestBuffer = _RequestBuffer()
+        self.reassemblyBuffer = _ReassemblyBuffer()
+        # Ids of the requests whose handlers are still running
+        self.inFlightRequests: set[bytes] = set()
+        # Packages waiting to be sent to each client
+        self.outbox: dict[tuple[str, int], list[bytes]] = {}
+
+        self.malformedPackages = 0
+        self.inFlightRetransmits = 0
+        self.resendRequests = 0
+        self.selectiveAcks = 0
+        self.datagramsSent = 0
+
+    def stats(self) -> dict[str, int]:
+        """Returns the counters of the server and how much its buffers hold.
+
+        Retransmitted requests are either answered from the request buffer (a buffer
+        hit) or acknowledged while they are handled (an in-flight retransmit).
+        """
+        return {
+            "malformedPackages": self.malformedPackages,
+            "requestBufferHits": self.requestBuffer.hits,
+            "requestBufferMisses": self.requestBuffer.misses,
+            "requestBufferEvictions": self.requestBuffer.evictions,
+            "inFlightRetransmits": self.inFlightRetransmits,
+            "resendRequests": self.resendRequests,
+            "selectiveAcks": self.selectiveAcks,
+            "fragmentsReceived": self.reassemblyBuffer.fragments,
+            "messagesReassembled": self.reassemblyBuffer.reassembled,
+            "partialMessagesDropped": self.reassemblyBuffer.dropped,
+            "datagramsSent": self.datagramsSent,
+            "inFlightRequests": len(self.inFlightRequests),
+            "bufferedResponses": len(self.requestBuffer),
+            "bufferedResponseBytes": self.requestBuffer.totalBytes,
+            "partialMessages": len(self.reassemblyBuffer.messages),
+            "partialMessageBytes": self.reassemblyBuffer.totalBytes,
+        }
+
+    def onTrace(self, callback: Callable[[Trace], None]) -> None:
+        """Traces every request, giving the trace to the callback once it is answered.
+
+        The trace is the current trace while the request is handled, so the message
+        handler can add its own spans to it. Set the callback to None to stop tracing.
+        """
+        self.onTraceCallback = callback
+
+    def _sendDatagram(self, datagram: bytes, address: tuple[str, int]) -> None:
+        raise NotImplementedError()
+
+    def _sendPackages(self, packagesInBytes: list[bytes], address: tuple[str, int]) -> None:
+        """Queues the packages to be sent by the next _flushOutbox."""
+        self.outbox.setdefault(address, []).extend(packagesInBytes)
+
+    def _flushOutbox(self) -> None:
+        """Sends the queued packages, packing those for the same client into shared datagrams."""
+        outbox = self.outbox
+        self.outbox = {}
+        for address, packagesInBytes in outbox.items():
+            for datagram in _coalescePackages(packagesInBytes):
+                self._sendDatagram(datagram, address)
+                self.datagramsSent += 1
+
+    def _receiveDatagram(self, packageBytes: bytes, address: tuple[str, int]) -> list[_Package]:
+        """Returns the requests completed by the packages in the given datagram."""
+        self.requestBuffer.expire()
+
+        try:
+            packages = _packagesFromBytes(packageBytes)
+        except MalformedPackageError:
+            # Ignoring corrupted package
+            self.malformedPackages += 1
+            return []
+
+        requests: list[_Package] = []
+        for package in packages:
+            request = self._receivePackage(package, address)
+            if request != None:
+                requests.append(request)
+        return requests
+
+    def _receivePackage(self, package: _Package, address: tuple[str, int]) -> _Package:
+        """Returns the request completed by the given package, or None if there is no new request to handle.
+
+        Retransmitted requests and resend requests are answered from the request buffer.
+        """
+        if package.flags & _FLAG_ACK:
+            self._receiveAck(package.uuid)
+            return None
+
+        # Retransmissions arriving while the request is handled are acknowledged, so the
+        # client stops retransmitting. Version 0 clients would take the ack for a response.
+        if package.uuid in self.inFlightRequests:
+            self.inFlightRetransmits += 1
+            if package.version != 0 and not package.flags & _FLAG_RESEND:
+                ack = _Package(b"", package.uuid, _FLAG_ACK)
+                self._sendPackages([_packageToBytes(ack)], address)
+            return None
+
+        item = self.requestBuffer.get(package.uuid)
+        if item != None:
+            fragmentIndices = None
+            if package.flags & _FLAG_RESEND:
+                self.resendRequests += 1
+                self._receiveResendRequest(package.uuid)
+                fragmentIndices = _resendRequestFragments(package)
+            elif package.fragmentIndex != package.fragmentCount - 1:
+                # A retransmitted request is answered once per pass over its fragments,
+                # on the last one, rather than once per fragment
+                return None
+            self._sendPackages(_packageToFragments(item.response, fragmentIndices), address)
+            return None
+
+        if package.flags & _FLAG_RESEND:
+            return None
+
+        message = self.reassemblyBuffer.add(package)
+        if message == None:
+            # Once the last fragment of a request has arrived, the client is told which
+            # fragments are missing, so it does not have to resend the others
+            if package.fragmentIndex == package.fragmentCount - 1 and package.version != 0:
+                missingFragments = self.reassemblyBuffer.missingFragments(package.uuid)
+                if missingFragments != None and len(missingFragments) > 0:
+                    self.selectiveAcks += 1
+                    sack = _makeResendRequest(package.uuid, missingFragments)
+                    self._sendPackages([_packageToBytes(sack)], address)
+            return None
+
+        return _Package(message, package.uuid, package.flags, version=package.version)
+
+    def _receiveAck(self, pushId: bytes) -> None:
+        """Called when a client acknowledges a push or response. Only servers that push messages use it."""
+        pass
+
+    def _receiveResendRequest(self, requestId: bytes) -> None:
+        """Called when a client asks for the missing fragments of a response, which it then keeps asking for."""
+        pass
+
+    def _respond(self, request: _Package, response: _Package, address: tuple[str, int]) -> None:
+        self.requestBuffer.add(request.uuid, _RequestBufferItem(request, response))
+        self._sendPackages(_packageToFragments(response), address)
+
+    def _startTrace(self, receivedAt: float, receivedBy: float):
+        """Starts the trace of a request whose datagram was received between the given times.
+
+        Returns:
+            - the token to reset the current trace with, or None if requests are not traced
+        """
+        if self.onTraceCallback == None:
+            return None
+
+        trace = Trace(receivedAt)
+        trace.add("recv", receivedAt, receivedBy)
+        return startTrace(trace)
+
+    def _finishTrace(self) -> None:
+        trace = currentTrace()
+        if trace != None and self.onTraceCallback != None:
+            trace.end = perf_counter()
+            self.onTraceCallback(trace)
+
+
+class Server(_BaseServer):
+    def __init__(self, port: int) -> None:
+        super().__init__(port)
         self.shouldClose = False
-        self.requestBuffer: dict[str, _RequestBufferItem] = {}
+        self.channel: socket = None
         pass
 
     def listen(self) -> None:
@@ -169,40 +1327,294 @@ class Server:
     def _serverListenCallback(
         self, args: tuple[bytes, tuple[str, int]], channel: socket
     ) -> bool:
-        self._sanitiseRequestBuffer()
+        self.channel = channel
+
+        packageBytes, address = args
+        receivedAt = perf_counter()
+        requests = self._receiveDatagram(packageBytes, address)
+        receivedBy = perf_counter()
+        for request in requests:
+            token = self._startTrace(receivedAt, receivedBy)
+            try:
+                responseMessage = self.onMessageCallback(request.message)
+                with span("encode"):
+                    response = _makeResponse(request, responseMessage)
+                with span("send"):
+                    self._respond(request, response, address)
+                self._finishTrace()
+            finally:
+                if token != None:
+                    resetTrace(token)
+        self._flushOutbox()
+
+        return self.shouldClose
+
+    def _sendDatagram(self, datagram: bytes, address: tuple[str, int]) -> None:
+        clientName, clientPort = address
+        udpSend(datagram, clientName, clientPort, self.channel)
+
+
+class _AsyncServerProtocol(asyncio.DatagramProtocol):
+    """Forwards the datagrams received by the event loop to an AsyncServer."""
+
+    def __init__(self, server: "AsyncServer") -> None:
+        self.server = server
+
+    def datagram_received(self, data: bytes, addr: tuple[str, int]) -> None:
+        self.server._onDatagram(data, addr)
+
+    def error_received(self, exc: Exception) -> None:
+        # ICMP errors (e.g. a client that went away) should not stop the server
+        pass
+
+
+class _PendingPush:
+    """A message pushed to a client, or a response sent the same way, that has not been acknowledged yet.
+
+    Responses have no future.
+    """
+
+    def __init__(
+        self, packagesInBytes: list[bytes], address: tuple[str, int], future: asyncio.Future = None
+    ) -> None:
+        self.packagesInBytes = packagesInBytes
+        self.address = address
+        self.future = future
+        self.attempts = 0
+        self.timer: asyncio.TimerHandle = None
 
-        packageBytes, (clientName, clientPort) = args
+
+class AsyncServer(_BaseServer):
+    """An RUDP server that runs on an asyncio event loop.
+
+    Unlike Server, each request is handled in its own task, so the message
+    handler can be a coroutine and a slow request does not hold up the
+    requests of other clients. It can also push messages to clients.
+
+    Requests still being handled ACK_DELAY seconds after they arrive are acknowledged,
+    and the others are acknowledged by their response. The response to a
+    request that was acknowledged is resent like a push until the client
+    acknowledges it, so the client does not have to keep asking for it.
+    """
+
+    def __init__(
+        self, port: int, maxPushAttempts: int = MAX_SEND_ATTEMPTS, reusePort: bool = False
+    ) -> None:
+        """Inits the server.
+
+        Set reusePort to run several servers on the same port, one per process. Each
+        client is always routed to the same process, so the request buffer of each
+        server sees all the retransmissions of its clients' requests.
+        """
+        super().__init__(port)
+        self.maxPushAttempts = maxPushAttempts
+        self.reusePort = reusePort
+        self.transport: asyncio.DatagramTransport = None
+        self._closed: asyncio.Event = None
+        self._tasks: set[asyncio.Task] = set()
+        self._isFlushScheduled = False
+        self.pendingPushes: dict[bytes, _PendingPush] = {}
+        # Ids of the requests in flight that have been acknowledged
+        self.acknowledgedRequests: set[bytes] = set()
+
+        self.pushes = 0
+        self.pushRetransmits = 0
+        self.failedPushes = 0
+        self.acksSent = 0
+        self.piggybackedAcks = 0
+        self.reliableResponses = 0
+        self.responseRetransmits = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            **super().stats(),
+            "pushes": self.pushes,
+            "pushRetransmits": self.pushRetransmits,
+            "failedPushes": self.failedPushes,
+            "acksSent": self.acksSent,
+            "piggybackedAcks": self.piggybackedAcks,
+            "reliableResponses": self.reliableResponses,
+            "responseRetransmits": self.responseRetransmits,
+            "pendingPushes": len(self.pendingPushes),
+            "runningHandlers": len(self._tasks),
+        }
+
+    async def listen(self) -> None:
+        """Listens for requests until close() is called."""
+        self._closed = asyncio.Event()
+        self.transport = await serverListenAsync(
+            self.port, lambda: _AsyncServerProtocol(self), self.reusePort
+        )
         try:
-            request = _packageFromBytes(packageBytes)
-            response = self._makeResponse(request)
-            udpSend(_packageToBytes(response), clientName, clientPort, channel)
+            await self._closed.wait()
+        finally:
+            self.transport.close()
+            for push in self.pendingPushes.values():
+                push.timer.cancel()
+                if push.future != None:
+                    push.future.cancel()
+            self.pendingPushes.clear()
 
-            if self.requestBuffer.get(request.uuid) == None:
-                self.requestBuffer[request.uuid] = _RequestBufferItem(request, response)
+    def close(self) -> None:
+        if self._closed != None:
+            self._closed.set()
 
-        except MalformedPackageError:
-            # Ignoring corrupted package
-            pass
+    def onMessage(
+        self,
+        callback: Callable[[bytes, tuple[str, int]], Union[bytes, Awaitable[bytes]]],
+    ) -> None:
+        """Sets the request handler.
 
-        return self.shouldClose
+        The handler may be a plain function or a coroutine function. Either way
+        it is given the request message and the address of the client, which
+        messages can be pushed to, and returns the response message.
+        """
+        self.onMessageCallback = callback
 
-    def _makeResponse(self, request: _Package) -> _Package:
-        if not self._isRequestDuplicate(request):
-            responseMessage = self.onMessageCallback(request.message)
-            return _Package(responseMessage, request.uuid)
-        else:
-            return self.requestBuffer[request.uuid].response
+    def push(self, message: bytes, address: tuple[str, int]) -> asyncio.Future:
+        """Sends the message to the client with the given address without it asking for it.
+
+        The push is retransmitted until the client acknowledges it. The returned future
+        is resolved when it does, or fails with DeliveryFailedError after maxPushAttempts
+        unacknowledged attempts.
+        """
+        package = _Package(message, uuid4().bytes, _FLAG_PUSH)
+        push = _PendingPush(
+            _packageToFragments(package), address, asyncio.get_running_loop().create_future()
+        )
+        self.pendingPushes[package.uuid] = push
+        self.pushes += 1
+        self._sendPush(package.uuid, push)
+        return push.future
+
+    def _sendPush(self, pushId: bytes, push: _PendingPush) -> None:
+        if push.attempts >= self.maxPushAttempts:
+            del self.pendingPushes[pushId]
+            if push.future == None:
+                # The client can still ask for the response from the request buffer
+                return
+            self.failedPushes += 1
+            if not push.future.done():
+                push.future.set_exception(
+                    DeliveryFailedError(push.address[0], push.address[1], push.attempts)
+                )
+            return
+
+        if push.attempts > 0:
+            if push.future == None:
+                self.responseRetransmits += 1
+            else:
+                self.pushRetransmits += 1
+        self._sendPackages(push.packagesInBytes, push.address)
+        push.timer = asyncio.get_running_loop().call_later(
+            min(INITIAL_RTO * 2**push.attempts, MAX_RTO), self._sendPush, pushId, push
+        )
+        push.attempts += 1
+
+    def _receiveAck(self, pushId: bytes) -> None:
+        push = self.pendingPushes.pop(pushId, None)
+        if push == None:
+            return
+
+        push.timer.cancel()
+        if push.future != None and not push.future.done():
+            push.future.set_result(None)
+
+    def _receiveResendRequest(self, requestId: bytes) -> None:
+        # The client has part of the response and asks for the rest itself
+        push = self.pendingPushes.pop(requestId, None)
+        if push != None:
+            push.timer.cancel()
+
+    def _onDatagram(self, packageBytes: bytes, address: tuple[str, int]) -> None:
+        receivedAt = perf_counter()
+        requests = self._receiveDatagram(packageBytes, address)
+        receivedBy = perf_counter()
+        for request in requests:
+            self.inFlightRequests.add(request.uuid)
+            # The task takes a copy of the current trace when it is created
+            token = self._startTrace(receivedAt, receivedBy)
+            task = asyncio.ensure_future(self._handleRequest(request, address))
+            if token != None:
+                resetTrace(token)
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        # Version 0 clients would take the ack for the response
+        requestIds = [request.uuid for request in requests if request.version != 0]
+        if len(requestIds) > 0:
+            asyncio.get_running_loop().call_later(
+                ACK_DELAY, self._acknowledgeRequests, requestIds, address
+            )
+
+    def _acknowledgeRequests(self, requestIds: list[bytes], address: tuple[str, int]) -> None:
+        """Acknowledges the requests that are still being handled.
+
+        Requests answered by now were acknowledged by their response. The acks go in
+        the same datagrams as the responses and pushes sent to the client in this pass
+        of the event loop.
+        """
+        acks = []
+        for requestId in requestIds:
+            if requestId not in self.inFlightRequests:
+                self.piggybackedAcks += 1
+                continue
+            self.acknowledgedRequests.add(requestId)
+            acks.append(_packageToBytes(_Package(b"", requestId, _FLAG_ACK)))
+
+        if len(acks) > 0:
+            self.acksSent += len(acks)
+            self._sendPackages(acks, address)
+
+    async def _handleRequest(self, request: _Package, address: tuple[str, int]) -> None:
+        try:
+            responseMessage = self.onMessageCallback(request.message, address)
+            if inspect.isawaitable(responseMessage):
+                responseMessage = await responseMessage
+
+            with span("encode"):
+                if len(responseMessage) >= COMPRESSION_EXECUTOR_THRESHOLD:
+                    response = await asyncio.get_running_loop().run_in_executor(
+                        None, _makeResponse, request, responseMessage
+                    )
+                else:
+                    response = _makeResponse(request, responseMessage)
+        except Exception:
+            # Let a retransmission of the request try again
+            traceback.print_exc()
+            return
+        finally:
+            self.inFlightRequests.discard(request.uuid)
+            isAcknowledged = request.uuid in self.acknowledgedRequests
+            self.acknowledgedRequests.discard(request.uuid)
+
+        with span("send"):
+            if isAcknowledged and request.flags & _FLAG_RELIABLE:
+                self._respondReliably(request, response, address)
+            else:
+                self._respond(request, response, address)
+        self._finishTrace()
+
+    def _respondReliably(self, request: _Package, response: _Package, address: tuple[str, int]) -> None:
+        """Sends the response like a push, resending it until the client acknowledges it."""
+        response.flags |= _FLAG_RELIABLE
+        self.requestBuffer.add(request.uuid, _RequestBufferItem(request, response))
+        push = _PendingPush(_packageToFragments(response), address)
+        self.pendingPushes[request.uuid] = push
+        self.reliableResponses += 1
+        self._sendPush(request.uuid, push)
 
-    def _isRequestDuplicate(self, request: _Package) -> bool:
-        return self.requestBuffer.get(request.uuid) != None
+    def _sendPackages(self, packagesInBytes: list[bytes], address: tuple[str, int]) -> None:
+        super()._sendPackages(packagesInBytes, address)
 
-    def _sanitiseRequestBuffer(self) -> None:
-        """Deletes all RequestBufferItems older than 30 seconds."""
+        # Responses completed in the same pass of the event loop share datagrams
+        if not self._isFlushScheduled:
+            self._isFlushScheduled = True
+            asyncio.get_running_loop().call_soon(self._flushOutbox)
 
-        keysToRemove: list[str] = []
-        for requestId, item in self.requestBuffer.items():
-            if time() - item.createdAt >= 30:
-                keysToRemove.append(requestId)
+    def _flushOutbox(self) -> None:
+        self._isFlushScheduled = False
+        super()._flushOutbox()
 
-        for key in keysToRemove:
-            del self.requestBuffer[key]
+    def _sendDatagram(self, datagram: bytes, address: tuple[str, int]) -> None:
+        self.transport.sendto(datagram, address)
@@ -0,0 +1,231 @@
+import unittest
+import uuid
+from unittest import mock
+from . import rudp
+from .hashing import hash
+from .rudp import (
+    INITIAL_RTO,
+    INITIAL_WINDOW,
+    MAX_FRAGMENT_SIZE,
+    MAX_RTO,
+    MAX_WINDOW,
+    MIN_RTO,
+    MIN_WINDOW,
+    Client,
+    MalformedPackageError,
+    _FLAG_ACK,
+    _FLAG_PUSH,
+    _BaseServer,
+    _Package,
+    _PackageSendRequest,
+    _ReassemblyBuffer,
+    _RequestBufferItem,
+    _RttEstimator,
+    _SendWindow,
+    _coalescePackages,
+    _makeResponse,
+    _packagesFromBytes,
+    _packageToBytes,
+    _packageToFragments,
+)
+
+CLIENT_ADDRESS = ("127.0.0.1", 5000)
+
+
+class HashTests(unittest.TestCase):
+    def test_crc16_xmodem(self):
+        self.assertEqual(hash(b"123456789"), b"\x31\xc3")
+
+    def test_accepts_memoryview(self):
+        data = b"some package bytes"
+        self.assertEqual(hash(memoryview(data)[5:]), hash(data[5:]))
+
+
+class PackageFormatTests(unittest.TestCase):
+    """Serialises packages and parses them back, with the real checksum"""
+
+    def assertSamePackage(self, expected: _Package, actual: _Package):
+        self.assertEqual(bytes(actual.message), bytes(expected.message))
+        self.assertEqual(actual.uuid, expected.uuid)
+        self.assertEqual(actual.flags, expected.flags)
+        self.assertEqual(actual.fragmentIndex, expected.fragmentIndex)
+        self.assertEqual(actual.fragmentCount, expected.fragmentCount)
+        self.assertEqual(actual.version, expected.version)
+
+    def test_version_1(self):
+        package = _Package(b"Method: FETCH", uuid.uuid4().bytes, _FLAG_PUSH)
+        packages = _packagesFromBytes(_packageToBytes(package))
+        self.assertEqual(len(packages), 1)
+        self.assertSamePackage(package, packages[0])
+
+    def test_version_0(self):
+        package = _Package(b"Method: FETCH", uuid.uuid4().bytes, version=0)
+        packageInBytes = _packageToBytes(package)
+        self.assertEqual(packageInBytes[2:38], str(uuid.UUID(bytes=package.uuid)).encode())
+
+        packages = _packagesFromBytes(packageInBytes)
+        self.assertEqual(len(packages), 1)
+        self.assertSamePackage(package, packages[0])
+
+    def test_coalesced(self):
+        packages = [
+            _Package(b"", uuid.uuid4().bytes, _FLAG_ACK),
+            _Package(b"first response", uuid.uuid4().bytes),
+            _Package(b"second response", uuid.uuid4().bytes),
+        ]
+        datagrams = _coalescePackages([_packageToBytes(package) for package in packages])
+        self.assertEqual(len(datagrams), 1)
+
+        received = _packagesFromBytes(datagrams[0])
+        self.assertEqual(len(received), len(packages))
+        for (package, receivedPackage) in zip(packages, received):
+            self.assertSamePackage(package, receivedPackage)
+
+    def test_fragmented(self):
+        message = bytes(range(256)) * (3 * MAX_FRAGMENT_SIZE // 256 + 1)
+        package = _Package(message, uuid.uuid4().bytes)
+        fragments = _packageToFragments(package)
+        self.assertEqual(len(fragments), 4)
+
+        reassemblyBuffer = _ReassemblyBuffer()
+        results = []
+        for fragment in reversed(fragments):
+            (received,) = _packagesFromBytes(fragment)
+            self.assertEqual(received.fragmentCount, 4)
+            results.append(reassemblyBuffer.add(received))
+        self.assertEqual(results[:-1], [None] * 3)
+        self.assertEqual(bytes(results[-1]), message)
+
+    def test_corrupted(self):
+        packageInBytes = bytearray(_packageToBytes(_Package(b"hello", uuid.uuid4().bytes)))
+        packageInBytes[-1] ^= 0xFF
+        with self.assertRaises(MalformedPackageError):
+            _packagesFromBytes(bytes(packageInBytes))
+
+    def test_corrupted_after_first_package_is_dropped(self):
+        first = _Package(b"hello", uuid.uuid4().bytes)
+        second = bytearray(_packageToBytes(_Package(b"world", uuid.uuid4().bytes)))
+        second[-1] ^= 0xFF
+        received = _packagesFromBytes(_packageToBytes(first) + bytes(second))
+        self.assertEqual(len(received), 1)
+        self.assertSamePackage(first, received[0])
+
+
+class RttEstimatorTests(unittest.TestCase):
+    def test_rto_follows_the_samples(self):
+        estimator = _RttEstimator()
+        self.assertEqual(estimator.rto, INITIAL_RTO)
+
+        # The first sample sets the deviation to half of it
+        estimator.addSample(0.1)
+        self.assertAlmostEqual(estimator.srtt, 0.1)
+        self.assertAlmostEqual(estimator.rttvar, 0.05)
+        self.assertAlmostEqual(estimator.rto, 0.3)
+
+        estimator.addSample(0.2)
+        self.assertAlmostEqual(estimator.rttvar, 0.75 * 0.05 + 0.25 * 0.1)
+        self.assertAlmostEqual(estimator.srtt, 0.875 * 0.1 + 0.125 * 0.2)
+        self.assertAlmostEqual(estimator.rto, 0.1125 + 4 * 0.0625)
+
+    def test_rto_is_bounded(self):
+        estimator = _RttEstimator()
+        estimator.addSample(0.001)
+        self.assertEqual(estimator.rto, MIN_RTO)
+
+        estimator = _RttEstimator()
+        estimator.addSample(10)
+        self.assertEqual(estimator.rto, MAX_RTO)
+
+    def test_retransmissions_back_off_up_to_max_rto(self):
+        # A client without its socket and threads, for its scheduling alone
+        client = Client.__new__(Client)
+        client.rttEstimators = {}
+        client.retransmitQueue = []
+        client._rttEstimator("localhost", 8000).addSample(0.1)
+
+        request = _PackageSendRequest([b""], "localhost", 8000)
+        delays = []
+        with mock.patch.object(rudp, "time", return_value=100.0):
+            for _ in range(6):
+                client._schedule(b"request", request)
+                delays.append(request.retransmitAt - 100.0)
+
+        for (delay, expected) in zip(delays, [0.3, 0.6, 1.2, 2.4, MAX_RTO, MAX_RTO]):
+            self.assertAlmostEqual(delay, expected)
+        self.assertEqual(request.attempts, 6)
+
+
+class SendWindowTests(unittest.TestCase):
+    def test_can_send(self):
+        window = _SendWindow()
+        # A request bigger than the window goes when nothing else is in flight
+        self.assertTrue(window.canSend(INITIAL_WINDOW + 1))
+
+        window.inFlight = INITIAL_WINDOW - 2
+        self.assertTrue(window.canSend(2))
+        self.assertFalse(window.canSend(3))
+
+    def test_slow_start_grows_by_each_package_acknowledged(self):
+        window = _SendWindow()
+        window.onAcknowledged(INITIAL_WINDOW)
+        self.assertEqual(window.cwnd, 2 * INITIAL_WINDOW)
+        window.onAcknowledged(2 * INITIAL_WINDOW)
+        self.assertEqual(window.cwnd, 4 * INITIAL_WINDOW)
+
+        for _ in range(10):
+            window.onAcknowledged(int(window.cwnd))
+        self.assertEqual(window.cwnd, MAX_WINDOW)
+
+    def test_loss_halves_the_window_once_per_rto(self):
+        window = _SendWindow()
+        window.cwnd = 40
+
+        window.onLoss(10.0, 0.5)
+        self.assertEqual((window.cwnd, window.ssthresh), (20, 20))
+        # Packages sent together are lost together
+        window.onLoss(10.4, 0.5)
+        self.assertEqual(window.cwnd, 20)
+
+        window.onLoss(10.5, 0.5)
+        self.assertEqual((window.cwnd, window.ssthresh), (10, 10))
+
+        for now in [11.0, 12.0, 13.0, 14.0]:
+            window.onLoss(now, 0.5)
+        self.assertEqual(window.cwnd, MIN_WINDOW)
+
+    def test_congestion_avoidance_grows_by_one_package_per_window(self):
+        window = _SendWindow()
+        window.cwnd = 20
+        window.onLoss(10.0, 0.5)
+
+        for _ in range(10):
+            window.onAcknowledged(1)
+        self.assertGreater(window.cwnd, 10.9)
+        self.assertLess(window.cwnd, 11)
+
+        for _ in range(11):
+            window.onAcknowledged(1)
+        self.assertGreater(window.cwnd, 11.9)
+        self.assertLess(window.cwnd, 12)
+
+
+class RequestBufferTests(unittest.TestCase):
+    def test_retransmitted_request_is_answered_once(self):
+        server = _BaseServer(0)
+        request = _Package(b"r" * (3 * MAX_FRAGMENT_SIZE + 1), uuid.uuid4().bytes)
+        requestFragments = _packageToFragments(request)
+        received = []
+        for fragment in requestFragments:
+            received.extend(server._receiveDatagram(fragment, CLIENT_ADDRESS))
+        self.assertEqual(len(received), 1)
+
+        response = _makeResponse(received[0], b"a" * (9 * MAX_FRAGMENT_SIZE + 1))
+        server.requestBuffer.add(request.uuid, _RequestBufferItem(received[0], response))
+
+        for fragment in requestFragments:
+            self.assertEqual(server._receiveDatagram(fragment, CLIENT_ADDRESS), [])
+        self.assertEqual(len(server.outbox[CLIENT_ADDRESS]), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,6 +3,7 @@
    It provides both client and server implementations.
 """
 
+import asyncio
 from typing import Callable
 from socket import *
 
@@ -50,3 +51,26 @@ def serverListen(toPort: int, callback: Callable[[tuple[bytes, tuple[str, int]],
         quit = callback(readIncomingPacket(serverSocket), serverSocket)
 
     serverSocket.close()
+
+
+async def serverListenAsync(
+    toPort: int,
+    protocolFactory: Callable[[], asyncio.DatagramProtocol],
+    reusePort: bool = False,
+) -> asyncio.DatagramTransport:
+    """Binds a UDP endpoint on the given port to the running event loop.
+
+    Unlike serverListen, this call does not block: incoming packages are delivered
+    to the datagram_received method of the protocol made by protocolFactory.
+
+    With reusePort, several processes can bind the same port (SO_REUSEPORT). The
+    kernel then hashes each sender's address to one of them, so a given client
+    always reaches the same process.
+
+    The returned transport is used to send replies and should be closed to stop listening.
+    """
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        protocolFactory, local_addr=("0.0.0.0", toPort), reuse_port=reusePort or None
+    )
+    return transport
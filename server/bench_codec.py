@@ -0,0 +1,115 @@
+"""Measures the CPU time the server spends parsing a request and encoding its response
+
+Compares the byte level codec with the str based parsing and encoding it replaced.
+Run it from the parent directory of the project folder with:
+
+    python -m networks-assignment-1-main.server.bench_codec
+"""
+
+import json
+import timeit
+from typing import Callable, Dict, List
+from .codec import parseRequest, encodeResponse
+
+# Number of times each case is run per measurement
+NUMBER = 20000
+# Number of measurements, of which the fastest is reported
+REPEAT = 5
+
+FETCH_REQUEST = (
+    "Method: FETCH\nData: "
+    + json.dumps({"timestamp": 1646486140.689381, "username": "john", "room": "default"})
+).encode()
+
+# Messages as stored in redis, for a FETCH response
+STORED_MESSAGES: List[bytes] = [
+    json.dumps(
+        {
+            "username": "john",
+            "room": "default",
+            "timestamp": 1646486140.689381 + i,
+            "message": "Hi everyone, this is message number %d" % i,
+        }
+    ).encode()
+    for i in range(20)
+]
+
+
+def stringParse(message: bytes) -> Dict[str, str]:
+    """Parses a request the way the server did before the codec"""
+    result = {}
+    for item in message.decode().split("\n"):
+        if len(item) > 0:
+            splitItem = item.split(":", maxsplit=1)
+            result[splitItem[0].strip()] = splitItem[1].strip()
+    return result
+
+
+def stringEncode(name: str, message: str, data=None, serializedData: str = None) -> bytes:
+    """Encodes a response the way the server did before the codec"""
+    response = ""
+    response += f"Status-name: {name}\n"
+    response += f"Status-message: {message}\n"
+
+    if data is not None:
+        serializedData = json.dumps(data)
+
+    if serializedData is not None:
+        response += f"Data: {serializedData}"
+
+    return response.encode()
+
+
+def stringFetch() -> bytes:
+    # The request data is parsed as the server does it, and not used after that
+    _ = json.loads(stringParse(FETCH_REQUEST)["Data"])
+    # Redis responses were decoded to str
+    newMessages = [message.decode() for message in STORED_MESSAGES]
+    return stringEncode(
+        "SUCCESS",
+        "Successfully fetched messages",
+        serializedData="[" + ",".join(newMessages) + "]",
+    )
+
+
+def codecFetch() -> bytes:
+    _ = json.loads(parseRequest(FETCH_REQUEST)["Data"])
+    return encodeResponse(
+        "SUCCESS",
+        "Successfully fetched messages",
+        serializedData=b"[" + b",".join(STORED_MESSAGES) + b"]",
+    )
+
+
+def stringStatus() -> bytes:
+    _ = json.loads(stringParse(FETCH_REQUEST)["Data"])
+    return stringEncode(
+        "AUTHORIZATION-ERROR", "Please perform LOGIN request to be authorized"
+    )
+
+
+def codecStatus() -> bytes:
+    _ = json.loads(parseRequest(FETCH_REQUEST)["Data"])
+    return encodeResponse(
+        "AUTHORIZATION-ERROR", "Please perform LOGIN request to be authorized"
+    )
+
+
+def measure(case: Callable[[], bytes]) -> float:
+    """Returns the fastest time of a run of the case, in microseconds"""
+    return min(timeit.repeat(case, number=NUMBER, repeat=REPEAT)) / NUMBER * 1e6
+
+
+if __name__ == "__main__":
+    assert stringFetch() == codecFetch()
+    assert stringStatus() == codecStatus()
+
+    for (name, before, after) in [
+        ("FETCH, 20 messages", stringFetch, codecFetch),
+        ("status only", stringStatus, codecStatus),
+    ]:
+        (beforeTime, afterTime) = (measure(before), measure(after))
+        print(
+            f"{name}: {beforeTime:.2f} us -> {afterTime:.2f} us "
+            f"({(1 - afterTime / beforeTime) * 100:.0f}% less)"
+        )
@@ -0,0 +1,301 @@
+"""Measures the throughput and latency of the server under load from many RUDP clients
+
+Every simulated client logs in, then sends requests picked at random from the request
+mix, waiting for a random think time between them, until the duration is up. A client
+that sends EXIT logs in again with its next request. The results are printed as JSON,
+with the latency percentiles in milliseconds.
+
+By default a server is started in a child process, keeping the chat in memory so no
+redis server is needed. With --storage fakeredis, it goes through the redis code of the
+server instead, with fakeredis standing in for redis. Use --host to load a server
+that is already running instead. Run it from the parent directory of the project
+folder with:
+
+    python -m networks-assignment-1-main.server.bench_load --clients 50 --duration 10
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+import uuid
+from typing import Dict, List, Optional
+from ..protocol.rudp import Client, DeliveryFailedError
+from .storage import MemoryStorage, RedisStorage
+
+# The methods a request mix can be made of, with LOGIN sent after each EXIT
+MIX_METHODS = ["MESSAGE", "FETCH", "EXIT"]
+DEFAULT_MIX = "MESSAGE=30,FETCH=65,EXIT=5"
+
+# Percentiles of the latency that are reported
+PERCENTILES = [50, 95, 99]
+
+# How long, in seconds, to wait for the server to answer before the benchmark starts
+STARTUP_TIMEOUT = 10
+
+
+class MethodStats:
+    """The latencies and number of failed requests of one method"""
+
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors = 0
+
+    def report(self, duration: float) -> Dict:
+        latencies = sorted(self.latencies)
+        report = {
+            "requests": len(latencies),
+            "errors": self.errors,
+            "throughput": round(len(latencies) / duration, 1),
+        }
+        for percentile in PERCENTILES:
+            report[f"p{percentile}"] = toMilliseconds(percentileOf(latencies, percentile))
+        report["max"] = toMilliseconds(latencies[-1] if len(latencies) > 0 else None)
+        return report
+
+
+def toMilliseconds(seconds: Optional[float]) -> Optional[float]:
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def percentileOf(sortedValues: List[float], percentile: float) -> Optional[float]:
+    """Returns the nearest-rank percentile of the sorted values, or None if there are none"""
+    if len(sortedValues) == 0:
+        return None
+
+    rank = math.ceil(percentile / 100 * len(sortedValues))
+    return sortedValues[max(rank - 1, 0)]
+
+
+def parseMix(mix: str) -> Dict[str, float]:
+    """Parses a request mix such as MESSAGE=30,FETCH=65,EXIT=5 into weights by method"""
+    weights = {}
+    for item in mix.split(","):
+        (method, _, weight) = item.partition("=")
+        method = method.strip().upper()
+        if method not in MIX_METHODS:
+            raise argparse.ArgumentTypeError(
+                f"{method} is not one of {', '.join(MIX_METHODS)}"
+            )
+        weights[method] = float(weight)
+
+    if sum(weights.values()) <= 0:
+        raise argparse.ArgumentTypeError("the request mix needs a positive weight")
+
+    return weights
+
+
+class SimulatedClient:
+    """A user of the chat that sends requests over its own RUDP client"""
+
+    def __init__(self, username: str, host: str, port: int, stats: Dict[str, MethodStats]):
+        self.username = username
+        self.host = host
+        self.port = port
+        self.stats = stats
+        self.client = Client()
+        self.isLoggedIn = False
+        self.lastSeq: Optional[int] = None
+
+    async def request(self, method: str, data: Dict) -> Optional[Dict]:
+        """Sends the request and records its latency
+
+        Returns:
+            - data of the response, or None if it failed
+        """
+        message = f"Method: {method}\nData: {json.dumps(data)}".encode()
+        start = time.perf_counter()
+        try:
+            response = await self.client.response(
+                await self.client.sendAsync(message, self.host, self.port)
+            )
+        except (TimeoutError, DeliveryFailedError):
+            self.stats[method].errors += 1
+            return None
+
+        self.stats[method].latencies.append(time.perf_counter() - start)
+        lines = response.split(b"\n")
+        if lines[0] != b"Status-name: SUCCESS":
+            self.stats[method].errors += 1
+            return None
+
+        return json.loads(lines[2][len(b"Data: ") :]) if len(lines) > 2 else {}
+
+    async def send(self, method: str) -> None:
+        if not self.isLoggedIn:
+            self.isLoggedIn = await self.request("LOGIN", {"username": self.username}) is not None
+            return
+
+        if method == "MESSAGE":
+            await self.request(
+                "MESSAGE", {"username": self.username, "message": f"Message from {self.username}"}
+            )
+        elif method == "FETCH":
+            data = {"username": self.username}
+            if self.lastSeq is not None:
+                data["afterSeq"] = self.lastSeq
+            response = await self.request("FETCH", data)
+            if response is not None:
+                self.lastSeq = response["lastSeq"]
+        elif method == "EXIT":
+            await self.request("EXIT", {"username": self.username})
+            self.isLoggedIn = False
+            self.lastSeq = None
+
+    async def run(self, deadline: float, weights: Dict[str, float], thinkTime: float) -> None:
+        methods = list(weights)
+        methodWeights = list(weights.values())
+        while time.perf_counter() < deadline:
+            await self.send(random.choices(methods, methodWeights)[0])
+            if thinkTime > 0:
+                await asyncio.sleep(random.expovariate(1 / thinkTime))
+
+        if self.isLoggedIn:
+            await self.request("EXIT", {"username": self.username})
+
+
+async def waitForServer(host: str, port: int) -> None:
+    """Waits until the server answers a request"""
+    client = Client(responseTimeout=1)
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while True:
+        try:
+            await client.response(client.send(b"Method: FETCH", host, port))
+            return
+        except (TimeoutError, DeliveryFailedError):
+            if time.monotonic() > deadline:
+                raise
+
+
+async def runBenchmark(
+    host: str, port: int, clients: int, duration: float, thinkTime: float, weights: Dict[str, float]
+) -> Dict:
+    """Runs the simulated clients for the duration and returns the results"""
+    await waitForServer(host, port)
+
+    stats = {method: MethodStats() for method in ["LOGIN"] + MIX_METHODS}
+    # Usernames are unique to the run, so runs against the same redis do not clash
+    runId = uuid.uuid4().hex[:8]
+    simulatedClients = [
+        SimulatedClient(f"bench-{runId}-{i}", host, port, stats) for i in range(clients)
+    ]
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[
+            simulatedClient.run(start + duration, weights, thinkTime)
+            for simulatedClient in simulatedClients
+        ]
+    )
+    elapsed = time.perf_counter() - start
+
+    total = MethodStats()
+    for methodStats in stats.values():
+        total.latencies.extend(methodStats.latencies)
+        total.errors += methodStats.errors
+
+    return {
+        "clients": clients,
+        "duration": round(elapsed, 3),
+        "thinkTime": thinkTime,
+        "mix": weights,
+        "total": total.report(elapsed),
+        "methods": {
+            method: methodStats.report(elapsed)
+            for (method, methodStats) in stats.items()
+            if len(methodStats.latencies) + methodStats.errors > 0
+        },
+    }
+
+
+def runLocalServer(port: int, storage: str) -> None:
+    """Runs the server with the given storage, with its output discarded"""
+    from .server import main
+
+    if storage == "fakeredis":
+        from fakeredis.aioredis import FakeRedis
+
+        chatStorage = RedisStorage(FakeRedis())
+    else:
+        chatStorage = MemoryStorage()
+
+    sys.stdout = open(os.devnull, "w")
+    asyncio.run(main(port, chatStorage=chatStorage))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load tests the Chatter server")
+    parser.add_argument(
+        "--host", help="address of a running server, instead of starting one"
+    )
+    parser.add_argument(
+        "--storage",
+        choices=["memory", "fakeredis"],
+        default="memory",
+        help="where the server started by the benchmark keeps the chat",
+    )
+    parser.add_argument("--port", type=int, default=8000, help="port of the server")
+    parser.add_argument("--clients", type=int, default=20, help="number of simulated clients")
+    parser.add_argument(
+        "--duration", type=float, default=10, help="how long to send requests for, in seconds"
+    )
+    parser.add_argument(
+        "--think-time",
+        type=float,
+        default=0.1,
+        help="mean time a client waits between requests, in seconds",
+    )
+    parser.add_argument(
+        "--mix",
+        type=parseMix,
+        default=DEFAULT_MIX,
+        help=f"weights of the methods sent, default {DEFAULT_MIX}",
+    )
+    parser.add_argument("--output", help="file to write the results to, instead of stdout")
+    args = parser.parse_args()
+
+    server = None
+    if args.host is None:
+        if args.storage == "fakeredis":
+            try:
+                import fakeredis
+            except ImportError:
+                print("Install fakeredis, or use the memory storage")
+                sys.exit(1)
+
+        server = multiprocessing.Process(
+            target=runLocalServer, args=(args.port, args.storage)
+        )
+        server.start()
+
+    try:
+        results = asyncio.run(
+            runBenchmark(
+                args.host or "127.0.0.1",
+                args.port,
+                args.clients,
+                args.duration,
+                args.think_time,
+                args.mix,
+            )
+        )
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as outputFile:
+            outputFile.write(output + "\n")
+
+    # The RUDP clients' receiving threads never return, so the process would not exit
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,77 @@
+"""Parses request messages and encodes response messages without going through str
+
+A request is only split into its header fields. The field values stay bytes, so the
+Data field goes straight to json.loads and the rest of the message is never decoded.
+Responses are joined once from pre-encoded status lines and already serialized data.
+"""
+
+import json
+from typing import Dict, Optional, Tuple
+
+# Status lines are only remembered for this many (status name, status message) pairs,
+# in case a status message is made from request data
+MAX_STATUS_LINES = 1024
+
+# Encoded "Status-name: ...\nStatus-message: ...\n" lines, by (status name, status message)
+_statusLines: Dict[Tuple[str, str], bytes] = {}
+
+
+def parseRequest(message: bytes) -> Optional[Dict[str, bytes]]:
+    """Parses the request message consisting of key/value lines
+
+    Args:
+        - message: request message
+
+    Returns:
+        - dictionary of the values by key, or None if a line is not a key/value pair
+    """
+    fields: Dict[str, bytes] = {}
+
+    for line in message.split(b"\n"):
+        if len(line) == 0:
+            continue
+
+        (key, separator, value) = line.partition(b":")
+        if len(separator) == 0:
+            return None
+
+        try:
+            fields[key.strip().decode()] = value.strip()
+        except UnicodeDecodeError:
+            return None
+
+    return fields
+
+
+def statusLines(name: str, message: str) -> bytes:
+    """Returns the encoded status name and status message lines of a response"""
+    lines = _statusLines.get((name, message))
+    if lines is None:
+        lines = f"Status-name: {name}\nStatus-message: {message}\n".encode()
+        if len(_statusLines) < MAX_STATUS_LINES:
+            _statusLines[(name, message)] = lines
+
+    return lines
+
+
+def encodeResponse(name: str, message: str, data=None, serializedData: bytes = None) -> bytes:
+    """Encodes a response message
+
+    Args:
+        - name: status name
+        - message: status message
+        - data: response data
+        - serializedData: response data that is already serialized to JSON
+
+    Returns:
+        - response message
+    """
+    lines = statusLines(name, message)
+
+    if data is not None:
+        serializedData = json.dumps(data).encode()
+
+    if serializedData is None:
+        return lines
+
+    return b"".join((lines, b"Data: ", serializedData))
@@ -1,13 +1,17 @@
-import redis
 import math
 import json
-from typing import Tuple, Dict, Union
+from typing import Tuple, Dict, Union, Callable, Hashable, Optional, List, Set
 import datetime
 import socket
-
-# Used to find/store items into redis
-MESSAGES = "messages"  # for storing messages
-USERS = "users"  # for storing active users
+import time
+import asyncio
+import traceback
+import functools
+import bisect
+from collections import OrderedDict
+from .codec import parseRequest, encodeResponse
+from .storage import Storage, storedMessage
+from ..protocol.tracing import span
 
 # Possibles RESPONSE_STATUS_NAMES the server can respond with
 RESPONSE_STATUS_NAMES = {
@@ -16,26 +20,592 @@ RESPONSE_STATUS_NAMES = {
     "unsupportedMethod": "UNSUPPORTED-METHOD",
     "formatError": "FORMAT-ERROR",
     "success": "SUCCESS",
+    "newMessage": "NEW-MESSAGE",  # status of the messages pushed to subscribers
 }
 
+# How long, in seconds, a cached session is trusted before the storage is asked again
+SESSION_CACHE_TTL = 5
+
+# The room users join when they log in, and that requests without a room id go to
+DEFAULT_ROOM = "default"
+# Room ids are at most this long, and cannot contain braces as they are used in hash tags
+MAX_ROOM_LENGTH = 64
+
+# The longest time, in seconds, a FETCH may wait for new messages
+MAX_FETCH_WAIT = 30
+
+# FETCH requests whose cursors fall in the same bucket of this many sequence ids share a read
+FETCH_CACHE_BUCKET_SIZE = 64
+# Number of message bytes the FETCH cache may hold
+FETCH_CACHE_MAX_BYTES = 32 * 1024 * 1024
+# How long, in seconds, a FETCH cache entry is used, so messages removed by the clean up
+# are not served for long
+FETCH_CACHE_MAX_AGE = 5
+
+# How long, in seconds, a fetch cursor may wait in memory before it is written to the storage
+CURSOR_FLUSH_INTERVAL = 1
+# Number of pending fetch cursors that triggers a write before the interval is up
+CURSOR_FLUSH_MAX_PENDING = 1000
+
+
+class SessionCache:
+    """Remembers which users are logged in, so authorizing a request needs no storage round trip
+
+    Sessions are added on LOGIN and removed on EXIT. Entries expire after ttl seconds,
+    so a session ended by another server process is noticed soon after. The same is
+    done for room memberships, keyed by (room, username).
+    """
+
+    def __init__(self, ttl: float = SESSION_CACHE_TTL):
+        self.ttl = ttl
+        self.sessions: Dict[Hashable, float] = {}
+
+    def contains(self, key: Hashable) -> bool:
+        expiresAt = self.sessions.get(key)
+        if expiresAt is None:
+            return False
+
+        if expiresAt < time.monotonic():
+            del self.sessions[key]
+            return False
+
+        return True
+
+    def add(self, key: Hashable) -> None:
+        self.sessions[key] = time.monotonic() + self.ttl
+
+    def remove(self, key: Hashable) -> None:
+        self.sessions.pop(key, None)
+
+
+class FetchCursorWriter:
+    """Collects fetch cursor updates in memory and writes them to the storage in batches
+
+    Every FETCH moves its user's cursor in the room, but only the latest cursor of each
+    user matters, so the updates are coalesced and written at once at most every
+    flushInterval seconds. The cursors in the storage therefore lag behind by at most that long, which only
+    makes the message clean up keep messages a little longer.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        flushInterval: float = CURSOR_FLUSH_INTERVAL,
+        maxPending: int = CURSOR_FLUSH_MAX_PENDING,
+    ):
+        self.storage = storage
+        self.flushInterval = flushInterval
+        self.maxPending = maxPending
+        self.pending: Dict[Tuple[str, str], int] = {}
+        self.isFlushRequested = asyncio.Event()
+
+    def update(self, room: str, username: str, cursor: int) -> None:
+        self.pending[(room, username)] = cursor
+        if len(self.pending) >= self.maxPending:
+            self.isFlushRequested.set()
+
+    def discard(self, room: str, username: str) -> None:
+        self.pending.pop((room, username), None)
+
+    async def flush(self) -> None:
+        """Writes the pending cursors to the storage"""
+        if len(self.pending) == 0:
+            return
+
+        (pending, self.pending) = (self.pending, {})
+        cursorsByRoom: Dict[str, Dict[str, int]] = {}
+        for ((room, username), cursor) in pending.items():
+            cursorsByRoom.setdefault(room, {})[username] = cursor
+
+        await self.storage.updateCursors(cursorsByRoom)
+
+    async def run(self) -> None:
+        """Flushes the pending cursors every flushInterval seconds, or sooner when many are pending"""
+        while True:
+            try:
+                await asyncio.wait_for(self.isFlushRequested.wait(), self.flushInterval)
+            except asyncio.TimeoutError:
+                pass
+
+            self.isFlushRequested.clear()
+            try:
+                await self.flush()
+            except Exception:
+                traceback.print_exc()
+
+
+class Subscription:
+    """The address of a subscriber, and how far it has acknowledged the messages pushed to it"""
+
+    def __init__(self, address: Tuple[str, int]):
+        self.address = address
+        # Sequence id of the last message that was acknowledged together with every message
+        # pushed to the subscriber before it, or None until there is one
+        self.cursor: int = None
+        # Sequence ids of the messages pushed since, in the order they were pushed, with
+        # whether each has been acknowledged
+        self.pushed: Dict[int, bool] = {}
+
+    def push(self, seq: int) -> None:
+        self.pushed[seq] = False
+
+    def acknowledge(self, seq: int) -> bool:
+        """Records that the message with the given sequence id was acknowledged
+
+        Returns:
+            - whether the cursor moved on
+        """
+        if seq not in self.pushed:
+            return False
+
+        self.pushed[seq] = True
+        isMoved = False
+        while len(self.pushed) > 0:
+            (first, isAcknowledged) = next(iter(self.pushed.items()))
+            if not isAcknowledged:
+                break
+
+            del self.pushed[first]
+            if self.cursor == None or first > self.cursor:
+                self.cursor = first
+                isMoved = True
+
+        return isMoved
+
+
+class Subscribers:
+    """Remembers, for each room, the address of the users that asked for its new messages to be pushed to them
+
+    A user that does not acknowledge a push is dropped, and can subscribe again.
+    """
+
+    def __init__(self):
+        self.subscriptions: Dict[str, Dict[str, Subscription]] = {}
+        # The AsyncServer that pushes the messages, set when it starts
+        self.server = None
+
+    def add(self, room: str, username: str, address: Tuple[str, int]) -> None:
+        self.subscriptions.setdefault(room, {})[username] = Subscription(address)
+
+    def remove(self, room: str, username: str) -> None:
+        roomSubscriptions = self.subscriptions.get(room)
+        if roomSubscriptions is None:
+            return
+
+        roomSubscriptions.pop(username, None)
+        if len(roomSubscriptions) == 0:
+            del self.subscriptions[room]
+
+    def publish(
+        self, room: str, seq: int, message: bytes, onDelivered: Callable[[str, int], None] = None
+    ) -> None:
+        """Pushes the message to every subscriber of the room
+
+        Args:
+            room: room the message was posted to
+            seq: sequence id of the message
+            message: message to push
+            onDelivered: called with the username and new cursor of each subscriber that
+                acknowledged every message pushed to it up to a later one than before
+        """
+        for (username, subscription) in self.subscriptions.get(room, {}).items():
+            subscription.push(seq)
+            delivery = self.server.push(message, subscription.address)
+            delivery.add_done_callback(
+                functools.partial(
+                    self._onPushDone, room, username, subscription, seq, onDelivered
+                )
+            )
+
+    def _onPushDone(
+        self,
+        room: str,
+        username: str,
+        subscription: Subscription,
+        seq: int,
+        onDelivered: Callable[[str, int], None],
+        delivery: asyncio.Future,
+    ) -> None:
+        if delivery.cancelled():
+            return
+
+        # Pushes to a subscription that was dropped or renewed since are ignored
+        if self.subscriptions.get(room, {}).get(username) is not subscription:
+            return
+
+        if delivery.exception() != None:
+            # The cursor stays before the lost message, so it is kept until the user
+            # subscribes again and fetches it
+            self.remove(room, username)
+            return
+
+        if subscription.acknowledge(seq) and onDelivered != None:
+            onDelivered(username, subscription.cursor)
+
+
+class MessageNotifier:
+    """Wakes up the FETCH requests waiting for new messages in a room
+
+    Every room has a version that goes up with each new message. A request notes the
+    version before reading the messages and then waits for it to change, so a message
+    stored in between the read and the wait is not missed. The condition of a room is
+    only kept while requests are waiting on it.
+    """
+
+    def __init__(self):
+        self.conditions: Dict[str, asyncio.Condition] = {}
+        # Number of requests waiting on the condition of each room
+        self.waiting: Dict[str, int] = {}
+        self.versions: Dict[str, int] = {}
+
+    def version(self, room: str) -> int:
+        return self.versions.get(room, 0)
+
+    async def notify(self, room: str) -> None:
+        """Wakes up the requests waiting for the room"""
+        self.versions[room] = self.version(room) + 1
+        condition = self.conditions.get(room)
+        if condition is None:
+            return
+
+        async with condition:
+            condition.notify_all()
+
+    async def wait(self, room: str, version: int, timeout: float) -> bool:
+        """Waits until the room has moved on from the given version
+
+        Returns:
+            - whether there are new messages before the timeout
+        """
+        condition = self.conditions.get(room)
+        if condition is None:
+            condition = asyncio.Condition()
+            self.conditions[room] = condition
+        self.waiting[room] = self.waiting.get(room, 0) + 1
+
+        try:
+            async with condition:
+                await asyncio.wait_for(
+                    condition.wait_for(lambda: self.version(room) != version), timeout
+                )
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting[room] -= 1
+            if self.waiting[room] == 0:
+                del self.waiting[room]
+                del self.conditions[room]
+
+
+class FetchCache:
+    """Shares the messages read from the storage between the FETCH requests of a room
+
+    Requests asking for the messages after sequence ids in the same bucket of bucketSize
+    ids share one read of the messages from the start of the bucket, and each takes the
+    messages after its own id from it. Entries are keyed by the version of the
+    room as well, and dropped when a new message moves the room to the next version.
+    The least recently used entries are evicted to keep the cache within maxBytes, and
+    entries are not used after maxAge seconds.
+    """
+
+    def __init__(
+        self,
+        bucketSize: int = FETCH_CACHE_BUCKET_SIZE,
+        maxBytes: int = FETCH_CACHE_MAX_BYTES,
+        maxAge: float = FETCH_CACHE_MAX_AGE,
+    ):
+        self.bucketSize = bucketSize
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        # (sequence ids, messages, size, time read, sequence id of the room's last message)
+        # of each (room, bucket, version)
+        self.entries: OrderedDict[
+            Tuple[str, int, int], Tuple[List[int], List[bytes], int, float, int]
+        ] = OrderedDict()
+        self.roomEntries: Dict[str, Set[Tuple[str, int, int]]] = {}
+        # Reads in progress, which requests for the same entry wait for
+        self.loading: Dict[Tuple[str, int, int], asyncio.Future] = {}
+        self.totalBytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def messagesAfter(
+        self, storage: Storage, room: str, version: int, afterSeq: int
+    ) -> Tuple[List[bytes], int]:
+        """Returns the messages of the room after the given sequence id
+
+        Args:
+            storage: storage to read the messages from on a cache miss
+            room: room id
+            version: version of the room, noted before the membership of the user was checked
+            afterSeq: sequence id of the last message the client has seen
+
+        Returns:
+            - tuple of the messages and the sequence id of the last one, or if there are none,
+              afterSeq or the sequence id of the room's last message if that is lower
+        """
+        key = (room, afterSeq // self.bucketSize, version)
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[3] > self.maxAge:
+            self.discard(key)
+            entry = None
+
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        else:
+            loading = self.loading.get(key)
+            if loading is not None:
+                self.hits += 1
+                # Shielded, so a waiting request that is cancelled does not cancel the read
+                with span("storage"):
+                    entry = await asyncio.shield(loading)
+
+            # Read again if there was no read in progress, or if it failed
+            if entry is None:
+                self.misses += 1
+                (entry, _, _) = await self.load(storage, key)
+
+        return self.messagesOf(entry, afterSeq)
+
+    async def memberMessagesAfter(
+        self, storage: Storage, room: str, version: int, afterSeq: int, username: str
+    ) -> Tuple[bool, Optional[int], List[bytes], int]:
+        """Returns the membership of the user in the room along with the messages after the given sequence id
+
+        On a cache miss the membership of the user is read in the same round trip as the
+        messages. Otherwise it is read on its own, and the messages are taken from the
+        cache.
+
+        Returns:
+            - tuple of what Storage.memberCursor and messagesAfter return
+        """
+        key = (room, afterSeq // self.bucketSize, version)
+        entry = self.entries.get(key)
+        isCached = entry is not None and time.monotonic() - entry[3] <= self.maxAge
+        if not isCached and key not in self.loading:
+            self.misses += 1
+            (entry, authenticated, cursor) = await self.load(storage, key, username)
+            return (authenticated, cursor, *self.messagesOf(entry, afterSeq))
+
+        with span("auth"):
+            (authenticated, cursor) = await storage.memberCursor(room, username)
+        if not authenticated or cursor is None:
+            return (authenticated, cursor, [], afterSeq)
+
+        return (authenticated, cursor, *await self.messagesAfter(storage, room, version, afterSeq))
+
+    def messagesOf(
+        self, entry: Tuple[List[int], List[bytes], int, float, int], afterSeq: int
+    ) -> Tuple[List[bytes], int]:
+        """Takes the messages after the given sequence id from the entry, see messagesAfter"""
+        (seqs, messages, _, _, lastSeq) = entry
+        start = bisect.bisect_right(seqs, afterSeq)
+        if start == len(seqs):
+            return ([], min(afterSeq, lastSeq))
+
+        return (messages[start:], seqs[-1])
+
+    async def load(
+        self, storage: Storage, key: Tuple[str, int, int], username: str = None
+    ) -> Tuple[Tuple[List[int], List[bytes], int, float, int], Optional[bool], Optional[int]]:
+        """Reads the messages of an entry from the storage and caches them
+
+        If a username is given, whether the user is logged in and their fetch cursor in
+        the room are read along with the messages, and returned after the entry.
+        Otherwise None is returned for them.
+        """
+        (room, bucket, version) = key
+        loading = asyncio.get_running_loop().create_future()
+        self.loading[key] = loading
+        (authenticated, cursor) = (None, None)
+
+        try:
+            with span("storage"):
+                if username is None:
+                    (seqs, messages, lastSeq) = await storage.readMessages(
+                        room, bucket * self.bucketSize
+                    )
+                else:
+                    (
+                        authenticated,
+                        cursor,
+                        seqs,
+                        messages,
+                        lastSeq,
+                    ) = await storage.readMemberMessages(room, username, bucket * self.bucketSize)
+            entry = (
+                seqs,
+                messages,
+                sum(len(message) for message in messages),
+                time.monotonic(),
+                lastSeq,
+            )
+
+            # An entry read while the room moved on is already stale
+            if messageNotifier.version(room) == version:
+                self.add(key, entry)
+
+            loading.set_result(entry)
+            return (entry, authenticated, cursor)
+        finally:
+            # The waiting requests read the messages themselves if this read failed
+            if not loading.done():
+                loading.set_result(None)
+            if self.loading.get(key) is loading:
+                del self.loading[key]
+
+    def add(
+        self, key: Tuple[str, int, int], entry: Tuple[List[int], List[bytes], int, float, int]
+    ) -> None:
+        (_, _, size, _, _) = entry
+        if size > self.maxBytes:
+            return
+
+        self.discard(key)
+        self.entries[key] = entry
+        self.roomEntries.setdefault(key[0], set()).add(key)
+        self.totalBytes += size
+
+        while self.totalBytes > self.maxBytes:
+            self.discard(next(iter(self.entries)))
+            self.evictions += 1
+
+    def discard(self, key: Tuple[str, int, int]) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+
+        (_, _, size, _, _) = entry
+        self.totalBytes -= size
+        roomEntries = self.roomEntries[key[0]]
+        roomEntries.discard(key)
+        if len(roomEntries) == 0:
+            del self.roomEntries[key[0]]
+
+    def invalidate(self, room: str) -> None:
+        """Drops the entries of the room, which a new or removed message has made stale"""
+        for key in list(self.roomEntries.get(room, ())):
+            self.discard(key)
+
+
+class MessageBroadcaster:
+    """Tells the FETCH requests waiting on a room and the room's subscribers about a new message
+
+    The waiting requests and subscribers of this process are told directly. When the
+    server runs several worker processes, the message is also published through the
+    storage, so the workers holding the other clients' requests and subscriptions
+    hear about it too.
+    """
+
+    def __init__(
+        self, storage: Storage, cursorWriter: FetchCursorWriter, workerId: int = None
+    ):
+        """Constructor method
+
+        Args:
+            storage: storage shared by the worker processes
+            cursorWriter: moves the fetch cursor of subscribers that received a message
+            workerId: id of this worker process, or None if it is the only one
+        """
+        self.storage = storage
+        self.cursorWriter = cursorWriter
+        self.workerId = workerId
+
+    async def broadcast(self, room: str, seq: int, pushMessage: bytes) -> None:
+        """Announces the message posted to the room with the given sequence id
+
+        Args:
+            room: room id
+            seq: sequence id of the message
+            pushMessage: message pushed to subscribers
+        """
+        await self.deliver(room, seq, pushMessage)
+
+        if self.workerId is not None:
+            with span("storage"):
+                await self.storage.publishNewMessage(
+                    json.dumps(
+                        {
+                            "worker": self.workerId,
+                            "room": room,
+                            "seq": seq,
+                            "push": pushMessage.decode(),
+                        }
+                    ),
+                )
+
+    async def deliver(self, room: str, seq: int, pushMessage: bytes) -> None:
+        """Wakes up the waiting requests and pushes the message to subscribers of this process"""
+        fetchCache.invalidate(room)
+        await messageNotifier.notify(room)
+
+        # A subscriber's cursor only moves past the messages it acknowledged, so a push
+        # still being retried is not trimmed away
+        subscribers.publish(
+            room,
+            seq,
+            pushMessage,
+            lambda subscriber, cursor: self.cursorWriter.update(room, subscriber, cursor),
+        )
+
+    async def run(self) -> None:
+        """Delivers the messages announced by the other workers"""
+        while True:
+            try:
+                async for announcement in self.storage.newMessages():
+                    details = json.loads(announcement)
+                    if details["worker"] == self.workerId:
+                        continue
+
+                    await self.deliver(
+                        details["room"], details["seq"], details["push"].encode()
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                traceback.print_exc()
+                await asyncio.sleep(1)
+
+
+# Shared by the handlers of every request
+sessionCache = SessionCache()
+membershipCache = SessionCache()
+messageNotifier = MessageNotifier()
+fetchCache = FetchCache()
+subscribers = Subscribers()
+
 """ Responsible for providing an interface to respond to a clients request
 
 """
 
 
 class RequestHandlers:
-    def __init__(self, message: bytes, redisClient: redis):
+    def __init__(
+        self,
+        message: bytes,
+        storage: Storage,
+        cursorWriter: FetchCursorWriter,
+        broadcaster: MessageBroadcaster,
+    ):
         """Constructor method
 
         Args:
             message: contents of request from client
-            redisClient: connection to the redis client
+            storage: where users, rooms and messages are kept
+            cursorWriter: batches the fetch cursor updates
+            broadcaster: announces new messages
         """
-        self.message = message.decode()
-        self.redisClient = redisClient
+        self.message = message
+        self.storage = storage
+        self.cursorWriter = cursorWriter
+        self.broadcaster = broadcaster
 
-    async def loginUser(self, username: str) -> str:
-        """Logs in user by labelling them as an active user
+    async def loginUser(self, username: str) -> bytes:
+        """Logs in user by labelling them as an active user, and joins them to the default room
 
         Args:
             username: identifier used for user
@@ -43,47 +613,44 @@ class RequestHandlers:
         Returns:
             None
         """
-        activeUsers = await self.redisClient.hgetall(USERS)
+        now = datetime.datetime.now().timestamp()
 
-        # Ensure user is not already active
-        for key in activeUsers:
-            if key == username:
-                return self.setResponseMessage(
-                    RESPONSE_STATUS_NAMES["authorizationError"],
-                    "Username is already taken",
-                )
+        # Ensure user is not already active. The username is claimed atomically, so two
+        # clients logging in at once cannot both get it, and the user joins the default
+        # room in the same step.
+        with span("storage"):
+            created = await self.storage.addSession(
+                username, json.dumps({"loginTimestamp": now}), DEFAULT_ROOM
+            )
+        if not created:
+            return self.setResponseMessage(
+                RESPONSE_STATUS_NAMES["authorizationError"],
+                "Username is already taken",
+            )
 
-        await self.redisClient.hset(
-            USERS,
-            username,
-            json.dumps(
-                {
-                    "lastMessageFetchTimestamp": datetime.datetime.now().timestamp(),
-                }
-            ),
-        )
+        sessionCache.add(username)
+        membershipCache.add((DEFAULT_ROOM, username))
 
-        test = self.setResponseMessage(
+        return self.setResponseMessage(
             RESPONSE_STATUS_NAMES["success"],
             "Successfully authorized",
             {"username": username},
         )
-        print(test)
-        return test
 
-    async def isAuthorized(self, username: str) -> Tuple[bool, str]:
+    async def isAuthorized(self, username: str) -> Tuple[bool, bytes]:
         """Checks if the client making a request has already been authenticated
 
         Returns:
             - tuple containing authentication bool value & potential response message: (bool, str)
         """
-        activeUsers = await self.redisClient.hgetall(USERS)
-        authenticated = False
-        responseMessage = ""
+        authenticated = sessionCache.contains(username)
+        responseMessage = b""
 
-        for key in activeUsers:
-            if username == key:
-                authenticated = True
+        if not authenticated:
+            with span("auth"):
+                authenticated = await self.storage.hasSession(username)
+            if authenticated:
+                sessionCache.add(username)
 
         if not authenticated:
             responseMessage = self.setResponseMessage(
@@ -93,129 +660,399 @@ class RequestHandlers:
 
         return (authenticated, responseMessage)
 
-    async def fetchMessages(self, timestamp: float, username: str) -> str:
-        """Retrieves messages whose timestamp is greater than the one provided ands sends them to the client
+    async def isMember(self, username: str, room: str) -> Tuple[bool, bytes]:
+        """Checks if the client making a request has joined the room
+
+        A member is always logged in too, since EXIT makes the user leave all their rooms.
+
+        Returns:
+            - tuple containing membership bool value & potential response message: (bool, str)
+        """
+        errorMessage = self.checkRoom(room)
+        if errorMessage is not None:
+            return (False, errorMessage)
+
+        if membershipCache.contains((room, username)):
+            return (True, b"")
+
+        with span("auth"):
+            (authenticated, cursor) = await self.storage.memberCursor(room, username)
+        return self.membershipResult(username, room, authenticated, cursor)
+
+    def membershipResult(
+        self, username: str, room: str, authenticated: bool, cursor: Optional[int]
+    ) -> Tuple[bool, bytes]:
+        """Turns the session and fetch cursor read from the storage into the result of isMember"""
+        if not authenticated:
+            return (
+                False,
+                self.setResponseMessage(
+                    RESPONSE_STATUS_NAMES["authorizationError"],
+                    "Please perform LOGIN request to be authorized",
+                ),
+            )
+
+        if cursor is None:
+            return (
+                False,
+                self.setResponseMessage(
+                    RESPONSE_STATUS_NAMES["authorizationError"],
+                    "Please perform JOIN request to enter the room",
+                ),
+            )
+
+        sessionCache.add(username)
+        membershipCache.add((room, username))
+        return (True, b"")
+
+    def checkRoom(self, room: str) -> Optional[bytes]:
+        """Checks that the room id can be used as a redis hash tag
+
+        Returns:
+            - error response message, or None if the room id is valid
+        """
+        if (
+            isinstance(room, str)
+            and 0 < len(room) <= MAX_ROOM_LENGTH
+            and "{" not in room
+            and "}" not in room
+        ):
+            return None
+
+        return self.setResponseMessage(
+            RESPONSE_STATUS_NAMES["dataRequired"],
+            f"Ensure that the room id is a string of 1 to {MAX_ROOM_LENGTH} characters without braces",
+        )
+
+    async def addMember(self, room: str, username: str) -> None:
+        """Adds the user to the room, starting their fetch cursor after the room's last message"""
+        with span("storage"):
+            await self.storage.addMember(room, username)
+        membershipCache.add((room, username))
+
+    async def joinRoom(self, room: str, username: str) -> bytes:
+        """Adds the user to the room, so they can send and fetch its messages
 
         Args:
-            timestamp: date & time timestamp
+            room: room id
+            username: identifier used for user
 
         Returns:
             - response message
         """
+        errorMessage = self.checkRoom(room)
+        if errorMessage is not None:
+            return errorMessage
+
         (authenticated, errorMessage) = await self.isAuthorized(username)
 
         if not authenticated:
             return errorMessage
 
-        messages = await self.redisClient.lrange(MESSAGES, start=0, end=1000)
-        now = datetime.datetime.now().timestamp()
-        newMessages = []
+        await self.addMember(room, username)
+        return self.setResponseMessage(
+            RESPONSE_STATUS_NAMES["success"],
+            "Successfully joined room",
+            {"username": username, "room": room},
+        )
+
+    async def leaveRoom(self, room: str, username: str) -> bytes:
+        """Removes the user from the room
+
+        Args:
+            room: room id
+            username: identifier used for user
+
+        Returns:
+            - response message
+        """
+        errorMessage = self.checkRoom(room)
+        if errorMessage is not None:
+            return errorMessage
+
+        membershipCache.remove((room, username))
+        subscribers.remove(room, username)
+        self.cursorWriter.discard(room, username)
+
+        # Removing the user doubles as the membership check
+        with span("storage"):
+            removed = await self.storage.removeMember(room, username)
+        if not removed:
+            return self.setResponseMessage(
+                RESPONSE_STATUS_NAMES["authorizationError"],
+                "Please perform JOIN request to enter the room",
+            )
+
+        return self.setResponseMessage(
+            RESPONSE_STATUS_NAMES["success"],
+            "Successfully left room",
+            {"username": username, "room": room},
+        )
+
+    async def fetchMessages(
+        self,
+        username: str,
+        afterSeq: Optional[int] = None,
+        timestamp: Optional[float] = None,
+        wait: float = 0,
+        room: str = DEFAULT_ROOM,
+    ) -> bytes:
+        """Retrieves messages of the room after the sequence id provided ands sends them to the client
+
+        Messages are stored in a sorted set per room scored by their sequence id, so only
+        the new messages are read, already in order, and they are sent on without being
+        decoded. Without afterSeq or timestamp, the messages after the user's fetch cursor
+        are sent.
+
+        Args:
+            username: identifier used for user
+            afterSeq: sequence id of the last message the client has seen
+            timestamp: date & time timestamp, for clients that do not know about sequence ids
+            wait: if there are no new messages, how many seconds to wait for one before
+                responding, up to MAX_FETCH_WAIT
+            room: room id
+
+        Returns:
+            - response message
+        """
+        errorMessage = self.checkRoom(room)
+        if errorMessage is not None:
+            return errorMessage
+
+        if afterSeq is not None and afterSeq < 0:
+            return self.setResponseMessage(
+                RESPONSE_STATUS_NAMES["dataRequired"],
+                "Ensure that afterSeq is a sequence id of 0 or more",
+            )
 
-        # Get messages
-        for item in messages:
-            item = json.loads(item)
-            date = datetime.datetime.fromtimestamp(item["timestamp"])
+        version = messageNotifier.version(room)
+        cursor = None
+        newMessages = None
 
-            if date > datetime.datetime.fromtimestamp(timestamp):
-                newMessages.append(item)
+        if afterSeq is not None and not membershipCache.contains((room, username)):
+            # The membership check is sent along with the read of the messages
+            (authenticated, cursor, newMessages, lastSeq) = await fetchCache.memberMessagesAfter(
+                self.storage, room, version, afterSeq, username
+            )
+            (joined, errorMessage) = self.membershipResult(
+                username, room, authenticated, cursor
+            )
+            if not joined:
+                return errorMessage
+        elif not membershipCache.contains((room, username)) or (
+            afterSeq is None and timestamp is None
+        ):
+            with span("auth"):
+                (authenticated, cursor) = await self.storage.memberCursor(room, username)
+            (joined, errorMessage) = self.membershipResult(
+                username, room, authenticated, cursor
+            )
+            if not joined:
+                return errorMessage
+
+        if timestamp is not None and afterSeq is None:
+            return await self.fetchMessagesSince(timestamp, username, wait, room, version)
 
-        # Update active user details, reflecting latest fetch timestamp
-        activeUser = json.loads(await self.redisClient.hget(USERS, username))
-        details = {
-            "lastMessageFetchTimestamp": now,
-        }
-        await self.redisClient.hset(name=USERS, key=username, value=json.dumps(details))
+        if afterSeq is None:
+            afterSeq = cursor
+
+        if newMessages is None:
+            # Requests of the room's other members may have read these messages already
+            (newMessages, lastSeq) = await fetchCache.messagesAfter(
+                self.storage, room, version, afterSeq
+            )
+
+        if len(newMessages) == 0 and wait > 0:
+            with span("wait"):
+                isNotified = await messageNotifier.wait(room, version, min(wait, MAX_FETCH_WAIT))
+            if isNotified:
+                # All the requests woken up by the message share one read
+                (newMessages, lastSeq) = await fetchCache.messagesAfter(
+                    self.storage, room, messageNotifier.version(room), afterSeq
+                )
+
+        # The client has seen every message up to the one it asked from, so that is the
+        # point retention may clean up to for this user. An id past the room's last
+        # message is taken as that message, so the cursor cannot skip messages to come.
+        self.cursorWriter.update(room, username, min(afterSeq, lastSeq))
 
-        sortedMessages = sorted(newMessages, key=lambda x: x["timestamp"])
         return self.setResponseMessage(
             RESPONSE_STATUS_NAMES["success"],
             "Successfully fetched messages",
-            sortedMessages,
+            serializedData=b"".join(
+                (
+                    b'{"messages": [',
+                    b",".join(newMessages),
+                    b'], "lastSeq": ',
+                    str(lastSeq).encode(),
+                    b"}",
+                )
+            ),
+        )
+
+    async def fetchMessagesSince(
+        self, timestamp: float, username: str, wait: float, room: str, version: int
+    ) -> bytes:
+        """Retrieves messages of the room whose timestamp is greater than the one provided
+
+        Serves the FETCH requests of clients that do not know about sequence ids. The
+        messages kept by the clean up are read and filtered by their timestamp, and sent
+        as a list like before.
+
+        Returns:
+            - response message
+        """
+
+        async def readMessages(version: int) -> List[Dict]:
+            (messages, _) = await fetchCache.messagesAfter(self.storage, room, version, 0)
+            return [
+                details
+                for details in map(json.loads, messages)
+                if details["timestamp"] > timestamp
+            ]
+
+        newMessages = await readMessages(version)
+
+        if len(newMessages) == 0 and wait > 0:
+            with span("wait"):
+                isNotified = await messageNotifier.wait(room, version, min(wait, MAX_FETCH_WAIT))
+            if isNotified:
+                newMessages = await readMessages(messageNotifier.version(room))
+
+        # The client has seen every message before the first one it is sent
+        if len(newMessages) > 0:
+            self.cursorWriter.update(room, username, newMessages[0]["seq"] - 1)
+
+        return self.setResponseMessage(
+            RESPONSE_STATUS_NAMES["success"], "Successfully fetched messages", newMessages
         )
 
-    async def storeMessage(self, message: str, username: str) -> str:
+    async def storeMessage(
+        self, message: str, username: str, room: str = DEFAULT_ROOM
+    ) -> bytes:
         """Store message sent by client
 
+        The message is given the room's next sequence id, which clients fetch from.
+
         Args:
             - message to be stored
+            - room the message is posted to
 
         Returns:
             - response message
         """
-        (authenticated, errorMessage) = await self.isAuthorized(username)
+        (joined, errorMessage) = await self.isMember(username, room)
 
-        if not authenticated:
+        if not joined:
             return errorMessage
 
-        messageDetails = {
-            "username": username,
-            "timestamp": datetime.datetime.now().timestamp(),
-            "message": message,
-        }
+        details = json.dumps(
+            {
+                "username": username,
+                "room": room,
+                "timestamp": datetime.datetime.now().timestamp(),
+                "message": message,
+            }
+        )
+
+        with span("storage"):
+            seq = await self.storage.appendMessage(room, details)
+        await self.broadcaster.broadcast(
+            room,
+            seq,
+            self.setResponseMessage(
+                RESPONSE_STATUS_NAMES["newMessage"],
+                "New message",
+                serializedData=storedMessage(seq, details),
+            ),
+        )
 
-        await self.redisClient.lpush(MESSAGES, json.dumps(messageDetails))
         return self.setResponseMessage(
             RESPONSE_STATUS_NAMES["success"],
             "Successfully stored message",
             {"username": username},
         )
 
-    async def removeUser(self, username: str) -> str:
-        """Removes the user with the provided address (from constructor)
+    async def subscribe(
+        self, username: str, address: Tuple[str, int], room: str = DEFAULT_ROOM
+    ) -> bytes:
+        """Pushes new messages of the room to the client from now on
+
+        Args:
+            username: identifier used for user
+            address: address of the client the messages are pushed to
+            room: room id
 
         Returns:
             - response message
         """
-        (authenticated, errorMessage) = await self.isAuthorized(username)
+        (joined, errorMessage) = await self.isMember(username, room)
 
-        if not authenticated:
+        if not joined:
             return errorMessage
 
-        await self.redisClient.hdel(USERS, username)
+        subscribers.add(room, username, address)
+        return self.setResponseMessage(
+            RESPONSE_STATUS_NAMES["success"], "Successfully subscribed", {"username": username},
+        )
+
+    async def removeUser(self, username: str) -> bytes:
+        """Removes the user with the provided address (from constructor), making them leave all their rooms
+
+        Returns:
+            - response message
+        """
+        sessionCache.remove(username)
+        # Removing the session doubles as the session check
+        with span("storage"):
+            (removed, rooms) = await self.storage.removeSession(username)
+        for room in rooms:
+            membershipCache.remove((room, username))
+            subscribers.remove(room, username)
+            self.cursorWriter.discard(room, username)
+
+        if not removed:
+            return self.setResponseMessage(
+                RESPONSE_STATUS_NAMES["authorizationError"],
+                "Please perform LOGIN request to be authorized",
+            )
+
         return self.setResponseMessage(
             RESPONSE_STATUS_NAMES["success"], "Successfully removed user", {"username": username},
         )
 
-    def setResponseMessage(self, name: str, message: str, data=None) -> str:
+    def setResponseMessage(
+        self, name: str, message: str, data=None, serializedData: bytes = None
+    ) -> bytes:
         """Setting the response message to be sent back to client
 
         Args:
             - name: status name
             - message: status message
             - data: response data
+            - serializedData: response data that is already serialized to JSON
 
         Returns:
             - response message
         """
-        response = ""
-        response += f"Status-name: {name}\n"
-        response += f"Status-message: {message}\n"
-
-        if data is not None:
-            response += f"Data: {json.dumps(data)}"
+        with span("encode"):
+            return encodeResponse(name, message, data, serializedData)
 
-        return response
-
-    def parseMessage(self) -> Tuple[bool, Union[str, Dict[str, str]]]:
+    def parseMessage(self) -> Tuple[bool, Union[bytes, Dict[str, bytes]]]:
         """Parses the request message consisting of key/value pairs and returns a Dict of these values
 
+        The values are left as bytes, e.g. for the Data value to be given to json.loads.
+
         Returns:
             - Tuple having an error bool value with either a dictionary or response message
         """
-        message = self.message
-        splitMessage = message.split("\n")
-        result = {}
+        result = parseRequest(self.message)
 
-        try:
-            for item in splitMessage:
-                if len(item) > 0:
-                    splitItem = item.split(":", maxsplit=1)
-                    result[splitItem[0].strip()] = splitItem[1].strip()
-
-            return (False, result)
-        except:
+        if result is None:
             responseMessage = self.setResponseMessage(
                 RESPONSE_STATUS_NAMES["formatError"],
                 "Format of request is not parsable",
             )
             return (True, responseMessage)
+
+        return (False, result)
@@ -0,0 +1,116 @@
+"""Finds where the time of the server goes, while it is switched on
+
+Two tools can be switched on and off while the server runs:
+    - tracing records how long each stage of a request takes (recv, parse, auth,
+      storage, wait, encode, send) in spanLatency, by method and stage, and keeps the
+      spans of the slowest recent requests in slowTraces
+    - the SamplingProfiler samples the stack of the event loop thread at an interval,
+      and writes how often each stack was seen as collapsed stacks, which flamegraph.pl
+      or speedscope turn into a flame graph
+
+Both cost nothing but a check of whether they are on while they are off.
+"""
+
+import os
+import sys
+import threading
+from collections import deque
+from typing import Deque, Dict
+from .stats import Histograms
+from ..protocol.tracing import Trace
+
+# How often, in seconds, the profiler samples the stack
+PROFILE_INTERVAL = 0.005
+
+# Traced requests taking at least this many seconds are kept in slowTraces
+SLOW_TRACE_THRESHOLD = 0.05
+MAX_SLOW_TRACES = 32
+
+# Time spent in each stage of the traced requests, by "method/stage"
+spanLatency = Histograms()
+# Spans of the most recent traced requests that took at least SLOW_TRACE_THRESHOLD
+slowTraces: Deque[Dict] = deque(maxlen=MAX_SLOW_TRACES)
+
+
+def recordTrace(trace: Trace) -> None:
+    """Adds the spans of the traced request to spanLatency, and keeps the trace if it was slow"""
+    name = trace.name or "UNKNOWN"
+    for (stage, start, end) in trace.spans:
+        spanLatency.record(f"{name}/{stage}", end - start)
+    spanLatency.record(f"{name}/total", trace.end - trace.start)
+
+    if trace.end - trace.start >= SLOW_TRACE_THRESHOLD:
+        slowTraces.append(trace.report())
+
+
+class SamplingProfiler:
+    """Counts the stacks a thread is seen in when sampled every interval seconds
+
+    Sampling is done by a thread of its own reading the stack of the sampled thread,
+    so the sampled thread runs unchanged and nothing is added to it while the profiler
+    is stopped.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        # Number of samples of each stack, from the outermost frame to the innermost
+        self.counts: Dict[str, int] = {}
+        self.samples = 0
+        # Names of the frames of each code object, made once per code object
+        self.frameNames: Dict[object, str] = {}
+        self.thread: threading.Thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def isRunning(self) -> bool:
+        return self.thread is not None
+
+    def start(self, threadId: int = None) -> None:
+        """Starts sampling the thread with the given id, by default the calling thread"""
+        if self.isRunning:
+            return
+
+        self.counts = {}
+        self.samples = 0
+        self.stopping.clear()
+        self.thread = threading.Thread(
+            target=self.run,
+            args=(threading.get_ident() if threadId is None else threadId,),
+            daemon=True,
+        )
+        self.thread.start()
+
+    def stop(self) -> None:
+        if not self.isRunning:
+            return
+
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def run(self, threadId: int) -> None:
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(threadId)
+            if frame is None:
+                return
+
+            names = []
+            while frame is not None:
+                code = frame.f_code
+                name = self.frameNames.get(code)
+                if name is None:
+                    name = self.frameNames[code] = (
+                        f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    )
+                names.append(name)
+                frame = frame.f_back
+
+            stack = ";".join(reversed(names))
+            self.counts[stack] = self.counts.get(stack, 0) + 1
+            self.samples += 1
+
+    def writeCollapsedStacks(self, path: str) -> None:
+        """Writes a "frame;frame;frame count" line for each stack sampled, most seen first"""
+        with open(path, "w") as profileFile:
+            for (stack, count) in sorted(self.counts.items(), key=lambda item: -item[1]):
+                profileFile.write(f"{stack} {count}\n")
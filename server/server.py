@@ -3,82 +3,177 @@ import socket
 import sys
 import asyncio
 import time
-import datetime
 import json
 from typing import Tuple
 import threading
-import aioredis
 import traceback
-from .handlers import RequestHandlers, MESSAGES, USERS, RESPONSE_STATUS_NAMES
-from ..protocol.rudp import Server
-
-# Used to keep track of time for when the messaging clean up needs to be done
-CURRENT_TIME = datetime.datetime.now()
+import argparse
+import os
+import signal
+from .handlers import (
+    RequestHandlers,
+    FetchCursorWriter,
+    MessageBroadcaster,
+    subscribers,
+    fetchCache,
+    DEFAULT_ROOM,
+    RESPONSE_STATUS_NAMES,
+)
+from .storage import Storage, RedisStorage, MemoryStorage
+from .stats import requestLatency, redisLatency
+from .profiling import SamplingProfiler, recordTrace, spanLatency, slowTraces
+from ..protocol.rudp import AsyncServer
+from ..protocol.tracing import currentTrace, span
 
 # how often the clean up function should be run in seconds
 INTERVAL_TIME = 5
 
-# Connect to redis server
-try:
-    redisClient = aioredis.from_url("redis://localhost", decode_responses=True)
-except:
-    print(
-        "Error connecting to redis server! Please ensure an instance of the redis server is running."
-    )
-    sys.exit(1)
+# The file the profiler writes to by default
+PROFILE_FILE = "profile.folded"
+
+# The methods whose latency is recorded under their own name, with the others recorded
+# as UNSUPPORTED
+METHODS = {
+    b"FETCH",
+    b"MESSAGE",
+    b"EXIT",
+    b"SUBSCRIBE",
+    b"JOIN",
+    b"LEAVE",
+    b"LOGIN",
+    b"STATS",
+    b"PROFILE",
+}
+
+# Addresses PROFILE requests are accepted from, as only the server's own host may
+# switch profiling on and off
+ADMIN_HOSTS = {"127.0.0.1", "::1", "localhost"}
+
+# Each worker process connects to redis when it starts, so no connection is shared
+# across processes
+storage: Storage = None
+# Batches the fetch cursor updates of every request
+cursorWriter: FetchCursorWriter = None
+# Announces new messages to the waiting requests and subscribers
+broadcaster: MessageBroadcaster = None
+# Id of this worker process, or None if it is the only one
+serverWorkerId: int = None
+# Samples the stack of the event loop while switched on
+profiler = SamplingProfiler()
+# File the collapsed stacks of this worker are written to when the profiler is switched off
+profileFile: str = None
+
+
+def connectToRedis() -> RedisStorage:
+    """Connects to the redis server, exiting if that is not possible"""
+    try:
+        # Only imported when redis is used, so the server runs without it otherwise
+        import aioredis
+
+        # Responses are left as bytes, so stored messages are sent on without being decoded
+        return RedisStorage(aioredis.from_url("redis://localhost"))
+    except:
+        print(
+            "Error connecting to redis server! Please ensure an instance of the redis server is running."
+        )
+        sys.exit(1)
 
 
-# Setting up event loop
-loop = asyncio.new_event_loop()
-asyncio.set_event_loop(loop)
+async def cleanupMessages() -> None:
+    """Removes messages that have been received by all members of their room"""
+    # The other workers' caches drop removed messages after FETCH_CACHE_MAX_AGE
+    for room in await storage.trimMessages():
+        fetchCache.invalidate(room)
 
 
-async def cleanupMessages() -> None:
-    """Removes messages that have been received by all active clients"""
-    activeUsers = await redisClient.hgetall(USERS)
-    messages = await redisClient.lrange(MESSAGES, start=0, end=1000)
-    messagesToRemove = []
-    now = datetime.datetime.now()
-    lowestDate = now
-
-    if len(activeUsers) == 0:
+async def cleanupMessagesPeriodically() -> None:
+    """Runs the message clean up every INTERVAL_TIME seconds"""
+    while True:
+        await asyncio.sleep(INTERVAL_TIME)
+        try:
+            await cleanupMessages()
+        except Exception:
+            traceback.print_exc()
+
+
+def collectStats() -> dict:
+    """Returns the latencies and counters of this server process"""
+    return {
+        "time": time.time(),
+        "worker": serverWorkerId,
+        "requests": requestLatency.report(),
+        "redis": redisLatency.report(),
+        "rudp": subscribers.server.stats() if subscribers.server is not None else {},
+        "fetchCache": {
+            "hits": fetchCache.hits,
+            "misses": fetchCache.misses,
+            "evictions": fetchCache.evictions,
+            "entries": len(fetchCache.entries),
+            "bytes": fetchCache.totalBytes,
+        },
+        "tracing": isTracing(),
+        "spans": spanLatency.report(),
+        "slowTraces": list(slowTraces),
+        "profiling": profiler.isRunning,
+    }
+
+
+def isTracing() -> bool:
+    return subscribers.server is not None and subscribers.server.onTraceCallback is not None
+
+
+def setTracing(enabled: bool) -> None:
+    """Switches the tracing of requests on or off"""
+    subscribers.server.onTrace(recordTrace if enabled else None)
+    print(f"Tracing is {'on' if enabled else 'off'}")
+
+
+def setProfiling(enabled: bool) -> None:
+    """Switches the sampling profiler on or off, writing the stacks it sampled when switched off"""
+    if enabled == profiler.isRunning:
+        return
+
+    if enabled:
+        # Called on the event loop thread, which is the thread sampled
+        profiler.start()
+        print("Profiling is on")
         return
 
-    # Find lowest date
-    for key in activeUsers:
-        user = json.loads(activeUsers[key])
-        date = datetime.datetime.fromtimestamp(user["lastMessageFetchTimestamp"])
-        if date < lowestDate:
-            lowestDate = date
+    profiler.stop()
+    try:
+        profiler.writeCollapsedStacks(profileFile)
+        print(f"Profiling is off, {profiler.samples} samples written to {profileFile}")
+    except OSError:
+        traceback.print_exc()
 
-    # Get messages to remove
-    for item in messages:
-        item = json.loads(item)
-        date = datetime.datetime.fromtimestamp(item["timestamp"])
 
-        if date < lowestDate:
-            messagesToRemove.append(json.dumps(item))
+def loadData(parsedMessage: dict):
+    """Deserializes the Data field of the request"""
+    with span("parse"):
+        return json.loads(parsedMessage["Data"])
 
-    # Remove messages
-    if lowestDate != now and len(messagesToRemove) > 0:
-        for message in messagesToRemove:
-            await redisClient.lrem(name=MESSAGES, count=1, value=message)
+
+async def dumpStatsPeriodically(path: str, interval: float) -> None:
+    """Appends the stats of this server process to the file, as a JSON line, every interval seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            with open(path, "a") as statsFile:
+                statsFile.write(json.dumps(collectStats()) + "\n")
+        except Exception:
+            traceback.print_exc()
 
 
-async def handleRequest(message: bytes) -> str:
+async def handleRequest(message: bytes, address: Tuple[str, int]) -> bytes:
     """Delegates the responsibility of handling request to the appropriate method depending on request method header
 
     Args:
         - message: request message
+        - address: address of the client that sent the request
     """
-    print("REceived request")
-    difference = datetime.datetime.now() - CURRENT_TIME
-    if difference.total_seconds() > INTERVAL_TIME:
-        await cleanupMessages()
-        pass
-
-    handlers = RequestHandlers(message, redisClient)
-    (error, parsedMessage) = handlers.parseMessage()
+    handlers = RequestHandlers(message, storage, cursorWriter, broadcaster)
+    with span("parse"):
+        (error, parsedMessage) = handlers.parseMessage()
 
     # If there was a FORMAT-ERROR
     if error:
@@ -91,33 +186,60 @@ async def handleRequest(message: bytes) -> str:
         )
 
     method = parsedMessage["Method"]
+    methodName = method.decode() if method in METHODS else "UNSUPPORTED"
+    trace = currentTrace()
+    if trace is not None:
+        trace.name = methodName
+
+    start = time.perf_counter()
+    try:
+        return await dispatchRequest(handlers, method, parsedMessage, address)
+    finally:
+        requestLatency.record(methodName, time.perf_counter() - start)
+
+
+async def dispatchRequest(
+    handlers: RequestHandlers, method: bytes, parsedMessage: dict, address: Tuple[str, int]
+) -> bytes:
+    """Calls the handler of the request method
 
-    if method == "FETCH":
+    Args:
+        - handlers: handlers of the request
+        - method: request method
+        - parsedMessage: fields of the request
+        - address: address of the client that sent the request
+    """
+    if method == b"FETCH":
         try:
-            print("Fetch called")
-            data = json.loads(parsedMessage["Data"])
-            print("Fetch called", data)
-            return await handlers.fetchMessages(data["timestamp"], data["username"])
+            data = loadData(parsedMessage)
+            return await handlers.fetchMessages(
+                data["username"],
+                int(data["afterSeq"]) if "afterSeq" in data else None,
+                data.get("timestamp"),
+                float(data.get("wait", 0)),
+                data.get("room", DEFAULT_ROOM),
+            )
         except:
             return handlers.setResponseMessage(
                 RESPONSE_STATUS_NAMES["dataRequired"],
-                "Ensure that timestamp exists within the data body line",
+                "Ensure that username exists within the data body line",
             )
 
-    elif method == "MESSAGE":
+    elif method == b"MESSAGE":
         try:
-            data = json.loads(parsedMessage["Data"])
-            return await handlers.storeMessage(data["message"], data["username"])
+            data = loadData(parsedMessage)
+            return await handlers.storeMessage(
+                data["message"], data["username"], data.get("room", DEFAULT_ROOM)
+            )
         except:
             return handlers.setResponseMessage(
                 RESPONSE_STATUS_NAMES["dataRequired"],
                 "Ensure that message exists within the data body line",
             )
 
-    elif method == "EXIT":
+    elif method == b"EXIT":
         try:
-            data = json.loads(parsedMessage["Data"])
-            print("exit data", data, type(data))
+            data = loadData(parsedMessage)
             return await handlers.removeUser(data["username"])
         except:
             return handlers.setResponseMessage(
@@ -125,10 +247,41 @@ async def handleRequest(message: bytes) -> str:
                 "Ensure that username exists within the data body line",
             )
 
-    elif method == "LOGIN":
+    elif method == b"SUBSCRIBE":
+        try:
+            data = loadData(parsedMessage)
+            return await handlers.subscribe(
+                data["username"], address, data.get("room", DEFAULT_ROOM)
+            )
+        except:
+            return handlers.setResponseMessage(
+                RESPONSE_STATUS_NAMES["dataRequired"],
+                "Ensure that username exists within the data body line",
+            )
+
+    elif method == b"JOIN":
         try:
-            print(parsedMessage)
-            data = json.loads(parsedMessage["Data"])
+            data = loadData(parsedMessage)
+            return await handlers.joinRoom(data["room"], data["username"])
+        except:
+            return handlers.setResponseMessage(
+                RESPONSE_STATUS_NAMES["dataRequired"],
+                "Ensure that room and username exist within the data body line",
+            )
+
+    elif method == b"LEAVE":
+        try:
+            data = loadData(parsedMessage)
+            return await handlers.leaveRoom(data["room"], data["username"])
+        except:
+            return handlers.setResponseMessage(
+                RESPONSE_STATUS_NAMES["dataRequired"],
+                "Ensure that room and username exist within the data body line",
+            )
+
+    elif method == b"LOGIN":
+        try:
+            data = loadData(parsedMessage)
             return await handlers.loginUser(data["username"])
         except:
             return handlers.setResponseMessage(
@@ -136,43 +289,213 @@ async def handleRequest(message: bytes) -> str:
                 "Ensure that username exists within the data body line",
             )
 
+    elif method == b"STATS":
+        return handlers.setResponseMessage(
+            RESPONSE_STATUS_NAMES["success"], "Successfully collected stats", collectStats()
+        )
+
+    elif method == b"PROFILE":
+        if address[0] not in ADMIN_HOSTS:
+            return handlers.setResponseMessage(
+                RESPONSE_STATUS_NAMES["authorizationError"],
+                "Profiling can only be switched from the server's own host",
+            )
+
+        try:
+            data = loadData(parsedMessage) if "Data" in parsedMessage else {}
+            if not isinstance(data, dict):
+                raise TypeError()
+            if "tracing" in data:
+                setTracing(bool(data["tracing"]))
+            if "profiling" in data:
+                setProfiling(bool(data["profiling"]))
+        except:
+            return handlers.setResponseMessage(
+                RESPONSE_STATUS_NAMES["dataRequired"],
+                "Ensure that the data body line is a JSON object",
+            )
+
+        return handlers.setResponseMessage(
+            RESPONSE_STATUS_NAMES["success"],
+            "Successfully switched profiling",
+            {"tracing": isTracing(), "profiling": profiler.isRunning, "profileFile": profileFile},
+        )
+
     else:
         return handlers.setResponseMessage(
             RESPONSE_STATUS_NAMES["unsupportedMethod"], "Provided method is unsupported"
         )
 
-def requestMessageWrapper(message: bytes) -> bytes:
-    """Used to launch the response in the event loop
+
+async def main(
+    port: int,
+    workerId: int = None,
+    chatStorage: Storage = None,
+    statsFile: str = None,
+    statsInterval: float = None,
+    profilePath: str = None,
+    trace: bool = False,
+) -> None:
+    """Runs the server until it is stopped
+
+    Requests are handled concurrently, so the storage calls of different clients overlap.
 
     Args:
-        - message: request message bytes
+        - port: port to listen on
+        - workerId: id of this worker process, or None if it is the only one
+        - chatStorage: where the chat is kept, the local redis server by default
+        - statsFile: file the stats are appended to every statsInterval seconds, if any
+        - statsInterval: how often the stats are written, in seconds
+        - profilePath: file the profiler writes to, with the worker id added before the
+          extension if there are several workers
+        - trace: whether requests are traced from the start
+    """
+    global storage, cursorWriter, broadcaster, serverWorkerId, profileFile
+    serverWorkerId = workerId
+    profileFile = profilePath or PROFILE_FILE
+    if workerId is not None:
+        (root, extension) = os.path.splitext(profileFile)
+        profileFile = f"{root}.{workerId}{extension}"
+    storage = connectToRedis() if chatStorage is None else chatStorage
+    cursorWriter = FetchCursorWriter(storage)
+    broadcaster = MessageBroadcaster(storage, cursorWriter, workerId)
+
+    server = AsyncServer(port, reusePort=workerId is not None)
+    server.onMessage(handleRequest)
+    # Stopping the process with SIGTERM shuts the server down cleanly, and SIGUSR1 and
+    # SIGUSR2 switch tracing and the profiler on and off
+    if hasattr(signal, "SIGTERM") and sys.platform != "win32":
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, server.close)
+        loop.add_signal_handler(signal.SIGUSR1, lambda: setTracing(not isTracing()))
+        loop.add_signal_handler(signal.SIGUSR2, lambda: setProfiling(not profiler.isRunning))
+    subscribers.server = server
+    if trace:
+        setTracing(True)
+    tasks = [asyncio.ensure_future(cursorWriter.run()), asyncio.ensure_future(storage.run())]
+    # Cleaning up is done by a single process
+    if workerId is None or workerId == 0:
+        tasks.append(asyncio.ensure_future(cleanupMessagesPeriodically()))
+    if statsFile is not None:
+        tasks.append(asyncio.ensure_future(dumpStatsPeriodically(statsFile, statsInterval)))
+    if workerId is not None:
+        tasks.append(asyncio.ensure_future(broadcaster.run()))
+        print(f"Worker {workerId} is listening...")
+    else:
+        print("Server is listening...")
+
+    try:
+        await server.listen()
+    finally:
+        for task in tasks:
+            task.cancel()
+        setProfiling(False)
+        await cursorWriter.flush()
+        await storage.close()
+
+
+def runServer(port: int, workerId: int = None, chatStorage: Storage = None, **options) -> None:
+    """Runs the server in this process until it is interrupted
+
+    The options are given to main, e.g. statsFile.
+    """
+    try:
+        asyncio.run(main(port, workerId, chatStorage, **options))
+    except KeyboardInterrupt:
+        pass
+    except Exception as error:
+        print(traceback.extract_stack())
+        print(error)
+        print("Error creating socket and binding to the address")
+        sys.exit(1)
+
 
-    Returns:
-        - response message
+def runWorkers(port: int, workers: int, **options) -> None:
+    """Runs the server in the given number of processes sharing the port, with the options given to main
+
+    The kernel routes each client to one worker (SO_REUSEPORT), so every worker only
+    keeps the RUDP state of its own clients. Workers are forked before any event loop
+    or redis connection exists, so each one makes its own.
     """
-    return (loop.run_until_complete(handleRequest(message))).encode()
-
-# Create socket and binding used for testing
-try:
-    port = 8000
-    server = Server(port)
-    server.onMessage(requestMessageWrapper)
-    print("Server is listening...")
-    server.listen()
-
-    # serverSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    # serverSocket.bind(("", port))
-    # print("Server is running...")
-    # print("Port:", port)
-except Exception as error:
-    print(traceback.extract_stack())
-    print(error)
-    print("Error creating socket and binding to the address")
-    sys.exit(1)
-
-
-
-# while True:
-#     message, address = serverSocket.recvfrom(1024)
-#     test = requestMessageWrapper(message)
-#     serverSocket.sendto(test, address)
+    children = []
+    for workerId in range(1, workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                runServer(port, workerId, **options)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    try:
+        runServer(port, 0, **options)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+            except ProcessLookupError:
+                pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the Chatter server")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes to handle requests with, e.g. one per core",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=["redis", "memory"],
+        default="redis",
+        help="where to keep the chat: the local redis server, or the memory of a single process",
+    )
+    parser.add_argument(
+        "--snapshot", help="file the memory storage is saved to and loaded from"
+    )
+    parser.add_argument(
+        "--stats-file",
+        help="file each worker appends its latencies and counters to, as JSON lines",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=60,
+        help="how often the stats are written to the stats file, in seconds",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="trace requests from the start, instead of after SIGUSR1 or a PROFILE request",
+    )
+    parser.add_argument(
+        "--profile-file",
+        default=PROFILE_FILE,
+        help="file the sampling profiler writes its collapsed stacks to when switched off",
+    )
+    args = parser.parse_args()
+
+    options = {
+        "statsFile": args.stats_file,
+        "statsInterval": args.stats_interval,
+        "profilePath": args.profile_file,
+        "trace": args.trace,
+    }
+
+    if args.storage == "memory":
+        if args.workers > 1:
+            print("The memory storage can only be used by a single process")
+            sys.exit(1)
+        runServer(args.port, chatStorage=MemoryStorage(args.snapshot), **options)
+    elif args.workers <= 1:
+        runServer(args.port, **options)
+    elif not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        print("Running several workers is not supported on this platform")
+        sys.exit(1)
+    else:
+        runWorkers(args.port, args.workers, **options)
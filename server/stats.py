@@ -0,0 +1,100 @@
+"""Records how long the server takes to answer each method and each redis round trip
+
+Latencies are counted in log-linear buckets, like an HDR histogram: every power of two
+of microseconds is split into 2 ** SUB_BUCKET_BITS buckets, so a percentile is off by
+at most 1 / 2 ** SUB_BUCKET_BITS of its value however long the server runs, and
+recording a latency is a dictionary update. Percentiles are reported in milliseconds.
+"""
+
+import math
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+# Each power of two of microseconds is split into 2 ** SUB_BUCKET_BITS buckets, which
+# keeps the reported percentiles within about 3% of the recorded latencies
+SUB_BUCKET_BITS = 5
+
+# Percentiles of the latency that are reported
+PERCENTILES = [50, 90, 99, 99.9]
+
+
+class LatencyHistogram:
+    """The number of latencies recorded in each bucket"""
+
+    def __init__(self):
+        # Number of latencies by bucket index, with only the buckets in use kept
+        self.counts: Dict[int, int] = {}
+        self.count = 0
+        # Sum and maximum of the latencies, in microseconds
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds: float) -> None:
+        micros = max(int(seconds * 1_000_000), 0)
+        # Latencies below 2 ** (SUB_BUCKET_BITS + 1) microseconds have a bucket each, and
+        # above that only the SUB_BUCKET_BITS bits after the leading bit are kept
+        magnitude = max(micros.bit_length() - SUB_BUCKET_BITS - 1, 0)
+        index = (magnitude << (SUB_BUCKET_BITS + 1)) + (micros >> magnitude)
+
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += micros
+        if micros > self.max:
+            self.max = micros
+
+    def percentile(self, percentile: float) -> int:
+        """Returns the highest latency, in microseconds, of the bucket the percentile is in"""
+        if self.count == 0:
+            return 0
+
+        rank = max(math.ceil(percentile / 100 * self.count), 1)
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                magnitude = index >> (SUB_BUCKET_BITS + 1)
+                subBucket = index & ((1 << (SUB_BUCKET_BITS + 1)) - 1)
+                return min(((subBucket + 1) << magnitude) - 1, self.max)
+
+        return self.max
+
+    def report(self) -> Dict:
+        report = {"count": self.count}
+        for percentile in PERCENTILES:
+            report[f"p{percentile:g}"] = self.percentile(percentile) / 1000
+        report["max"] = self.max / 1000
+        report["mean"] = round(self.total / self.count / 1000, 3) if self.count > 0 else 0
+        return report
+
+
+class Histograms:
+    """A latency histogram for each name, e.g. each method"""
+
+    def __init__(self):
+        self.histograms: Dict[str, LatencyHistogram] = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = LatencyHistogram()
+        histogram.record(seconds)
+
+    @contextmanager
+    def time(self, name: str) -> Iterator[None]:
+        """Records how long the body of the with statement takes"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def report(self) -> Dict[str, Dict]:
+        return {name: self.histograms[name].report() for name in sorted(self.histograms)}
+
+
+# Time from a request being handed to the server until its response is ready, by
+# method. FETCH requests that wait for new messages include the time they waited.
+requestLatency = Histograms()
+# Time of each round trip to redis, by the commands sent in it
+redisLatency = Histograms()
@@ -0,0 +1,588 @@
+"""Keeps the users, rooms and messages of the chat
+
+The request handlers go through a Storage, of which there are two kinds:
+    - RedisStorage keeps everything in redis, so it survives the server and is shared by
+      all of its worker processes
+    - MemoryStorage keeps everything in the server process, optionally saved to a
+      snapshot file, for a single process server that needs no redis server
+
+Messages are stored with a sequence id that goes up by one with each message of the
+room. Every member of a room has a fetch cursor, the sequence id of the last message
+they have seen, which the clean up trims the messages up to.
+"""
+
+import asyncio
+import json
+import os
+import traceback
+from typing import AsyncIterator, Dict, List, Optional, Set, Tuple
+from .stats import redisLatency
+
+# Used to find/store items into redis
+USERS = "users"  # for storing active users
+ROOMS = "rooms"  # for storing the rooms that have members or messages
+NEW_MESSAGES_CHANNEL = "new-messages"  # for telling the other server processes about new messages
+
+# The keys of a room are hash tagged with the room id, so the keys of one room are kept
+# together while different rooms spread across redis cluster slots/instances
+
+
+def roomMessagesKey(room: str) -> str:
+    """Key of the sorted set of the room's messages, scored by their sequence id"""
+    return f"messages:{{{room}}}"
+
+
+def roomCursorsKey(room: str) -> str:
+    """Key of the sorted set of the room's members, scored by the sequence id of the last message they have seen"""
+    return f"cursors:{{{room}}}"
+
+
+def roomSeqKey(room: str) -> str:
+    """Key of the counter the sequence ids of the room's messages are taken from"""
+    return f"seq:{{{room}}}"
+
+
+def userRoomsKey(username: str) -> str:
+    """Key of the set of rooms the user has joined"""
+    return f"rooms:{{{username}}}"
+
+
+# Gives the message the room's next sequence id and stores it, in one step so messages are
+# stored in the order of their ids. The id is put at the start of the message details.
+#   KEYS: sequence counter of the room, messages of the room
+#   ARGV: message details as a JSON object
+STORE_MESSAGE_SCRIPT = """
+local seq = redis.call("INCR", KEYS[1])
+redis.call("ZADD", KEYS[2], seq, '{"seq": ' .. seq .. ', ' .. string.sub(ARGV[1], 2))
+return seq
+"""
+
+# Logs the user in unless the username is taken, and then adds them to the room with their
+# fetch cursor after the room's last message, all in one round trip. NX keeps the cursor
+# of a user that is already a member.
+#   KEYS: users, sequence counter of the room, members of the room, rooms of the user, rooms
+#   ARGV: username, session details, room
+LOGIN_SCRIPT = """
+if redis.call("HSETNX", KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+local lastSeq = tonumber(redis.call("GET", KEYS[2]) or 0)
+redis.call("ZADD", KEYS[3], "NX", lastSeq, ARGV[1])
+redis.call("SADD", KEYS[4], ARGV[3])
+redis.call("SADD", KEYS[5], ARGV[3])
+return 1
+"""
+
+# How often, in seconds, MemoryStorage saves its snapshot
+SNAPSHOT_INTERVAL = 30
+
+
+def storedMessage(seq: int, details: str) -> bytes:
+    """Returns the message as it is stored: its details with the sequence id put at the start
+
+    Args:
+        - seq: sequence id of the message
+        - details: message details as a JSON object
+    """
+    return f'{{"seq": {seq}, {details[1:]}'.encode()
+
+
+class Storage:
+    """The operations the request handlers need from where the chat is kept"""
+
+    async def addSession(self, username: str, details: str, room: str) -> bool:
+        """Logs the user in, unless the username is already taken, and adds them to the room
+
+        The user joins the room like with addMember.
+
+        Returns:
+            - whether the user was logged in
+        """
+        raise NotImplementedError()
+
+    async def hasSession(self, username: str) -> bool:
+        raise NotImplementedError()
+
+    async def removeSession(self, username: str) -> Tuple[bool, List[str]]:
+        """Logs the user out, making them leave all their rooms
+
+        Returns:
+            - tuple of whether the user was logged in and the rooms they left
+        """
+        raise NotImplementedError()
+
+    async def addMember(self, room: str, username: str) -> None:
+        """Adds the user to the room, starting their fetch cursor after the room's last message
+
+        A user that is already a member keeps their cursor.
+        """
+        raise NotImplementedError()
+
+    async def removeMember(self, room: str, username: str) -> bool:
+        """Removes the user from the room
+
+        Returns:
+            - whether the user was a member
+        """
+        raise NotImplementedError()
+
+    async def memberCursor(self, room: str, username: str) -> Tuple[bool, Optional[int]]:
+        """Returns whether the user is logged in, and their fetch cursor in the room, or None if they are not a member"""
+        raise NotImplementedError()
+
+    async def appendMessage(self, room: str, details: str) -> int:
+        """Stores the message, see storedMessage, under the room's next sequence id
+
+        Args:
+            - room: room the message is posted to
+            - details: message details as a JSON object
+
+        Returns:
+            - sequence id of the message
+        """
+        raise NotImplementedError()
+
+    async def readMessages(self, room: str, fromSeq: int) -> Tuple[List[int], List[bytes], int]:
+        """Returns the sequence ids and the messages of the room, from the given sequence id on
+
+        The sequence id of the room's last message, or 0 if there has been none, is returned
+        after them. It is kept when the messages are trimmed.
+        """
+        raise NotImplementedError()
+
+    async def readMemberMessages(
+        self, room: str, username: str, fromSeq: int
+    ) -> Tuple[bool, Optional[int], List[int], List[bytes], int]:
+        """Returns what memberCursor and readMessages return, read together"""
+        raise NotImplementedError()
+
+    async def updateCursors(self, cursorsByRoom: Dict[str, Dict[str, int]]) -> None:
+        """Moves the fetch cursors of the given users, if they are still members of the room"""
+        raise NotImplementedError()
+
+    async def trimMessages(self) -> List[str]:
+        """Removes the messages that have been fetched by every member of their room
+
+        The oldest fetch cursor of a room's members is its low watermark: every message up
+        to it has been fetched by everyone. The messages of a room that has no members
+        left are all removed. The sequence ids of a room never go back though.
+
+        Returns:
+            - the rooms messages were removed from
+        """
+        raise NotImplementedError()
+
+    async def publishNewMessage(self, announcement: str) -> None:
+        """Tells the other server processes about a new message"""
+        raise NotImplementedError()
+
+    def newMessages(self) -> AsyncIterator[bytes]:
+        """Yields the new message announcements of the other server processes"""
+        raise NotImplementedError()
+
+    async def run(self) -> None:
+        """Does the background work of the storage until it is cancelled"""
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+class RedisStorage(Storage):
+    """Keeps the chat in redis
+
+    Users are kept in the USERS hash, and each room has a sorted set of its messages
+    scored by their sequence id, a sorted set of its members scored by their fetch
+    cursor and a sequence counter. The rooms that may have messages are kept in the
+    ROOMS set, so the clean up can find them. New messages are announced on the
+    NEW_MESSAGES_CHANNEL channel. Every round trip to redis is timed in redisLatency,
+    under the commands sent in it.
+    """
+
+    def __init__(self, redisClient):
+        """Constructor method
+
+        Args:
+            redisClient: connection to the redis client, which leaves responses as bytes
+        """
+        self.redisClient = redisClient
+
+    async def addSession(self, username: str, details: str, room: str) -> bool:
+        # HSETNX claims the username atomically, so two clients logging in at once
+        # cannot both get it
+        with redisLatency.time("EVAL"):
+            created = await self.redisClient.eval(
+                LOGIN_SCRIPT,
+                5,
+                USERS,
+                roomSeqKey(room),
+                roomCursorsKey(room),
+                userRoomsKey(username),
+                ROOMS,
+                username,
+                details,
+                room,
+            )
+        return bool(created)
+
+    async def hasSession(self, username: str) -> bool:
+        with redisLatency.time("HEXISTS"):
+            return bool(await self.redisClient.hexists(USERS, username))
+
+    async def removeSession(self, username: str) -> Tuple[bool, List[str]]:
+        with redisLatency.time("SMEMBERS"):
+            rooms = [
+                room.decode()
+                for room in await self.redisClient.smembers(userRoomsKey(username))
+            ]
+
+        async with self.redisClient.pipeline(transaction=False) as pipe:
+            pipe.hdel(USERS, username)
+            for room in rooms:
+                pipe.zrem(roomCursorsKey(room), username)
+            pipe.delete(userRoomsKey(username))
+            with redisLatency.time("HDEL+ZREM+DEL"):
+                (removed, *_) = await pipe.execute()
+
+        return (bool(removed), rooms)
+
+    async def addMember(self, room: str, username: str) -> None:
+        with redisLatency.time("GET"):
+            lastSeq = int(await self.redisClient.get(roomSeqKey(room)) or 0)
+
+        async with self.redisClient.pipeline(transaction=False) as pipe:
+            # NX keeps the cursor of a user that joins a room twice
+            pipe.zadd(roomCursorsKey(room), {username: lastSeq}, nx=True)
+            pipe.sadd(userRoomsKey(username), room)
+            pipe.sadd(ROOMS, room)
+            with redisLatency.time("ZADD+SADD"):
+                await pipe.execute()
+
+    async def removeMember(self, room: str, username: str) -> bool:
+        async with self.redisClient.pipeline(transaction=False) as pipe:
+            pipe.zrem(roomCursorsKey(room), username)
+            pipe.srem(userRoomsKey(username), room)
+            with redisLatency.time("ZREM+SREM"):
+                (removed, _) = await pipe.execute()
+
+        return bool(removed)
+
+    async def memberCursor(self, room: str, username: str) -> Tuple[bool, Optional[int]]:
+        async with self.redisClient.pipeline(transaction=False) as pipe:
+            pipe.hexists(USERS, username)
+            pipe.zscore(roomCursorsKey(room), username)
+            with redisLatency.time("HEXISTS+ZSCORE"):
+                (authenticated, cursor) = await pipe.execute()
+
+        return (bool(authenticated), None if cursor is None else int(cursor))
+
+    async def appendMessage(self, room: str, details: str) -> int:
+        # The room is registered again in case the clean up dropped it while it was empty
+        async with self.redisClient.pipeline(transaction=False) as pipe:
+            pipe.eval(STORE_MESSAGE_SCRIPT, 2, roomSeqKey(room), roomMessagesKey(room), details)
+            pipe.sadd(ROOMS, room)
+            with redisLatency.time("EVAL+SADD"):
+                (seq, _) = await pipe.execute()
+
+        return int(seq)
+
+    async def readMessages(self, room: str, fromSeq: int) -> Tuple[List[int], List[bytes], int]:
+        async with self.redisClient.pipeline(transaction=False) as pipe:
+            pipe.zrangebyscore(roomMessagesKey(room), min=fromSeq, max="+inf", withscores=True)
+            pipe.get(roomSeqKey(room))
+            with redisLatency.time("ZRANGEBYSCORE+GET"):
+                (messagesWithScores, lastSeq) = await pipe.execute()
+
+        return (
+            [int(score) for (_, score) in messagesWithScores],
+            [message for (message, _) in messagesWithScores],
+            int(lastSeq or 0),
+        )
+
+    async def readMemberMessages(
+        self, room: str, username: str, fromSeq: int
+    ) -> Tuple[bool, Optional[int], List[int], List[bytes], int]:
+        async with self.redisClient.pipeline(transaction=False) as pipe:
+            pipe.hexists(USERS, username)
+            pipe.zscore(roomCursorsKey(room), username)
+            pipe.zrangebyscore(roomMessagesKey(room), min=fromSeq, max="+inf", withscores=True)
+            pipe.get(roomSeqKey(room))
+            with redisLatency.time("HEXISTS+ZSCORE+ZRANGEBYSCORE+GET"):
+                (authenticated, cursor, messagesWithScores, lastSeq) = await pipe.execute()
+
+        return (
+            bool(authenticated),
+            None if cursor is None else int(cursor),
+            [int(score) for (_, score) in messagesWithScores],
+            [message for (message, _) in messagesWithScores],
+            int(lastSeq or 0),
+        )
+
+    async def updateCursors(self, cursorsByRoom: Dict[str, Dict[str, int]]) -> None:
+        # XX only updates users that are still members, so a cursor written after the
+        # user left does not bring them back
+        async with self.redisClient.pipeline(transaction=False) as pipe:
+            for (room, cursors) in cursorsByRoom.items():
+                pipe.zadd(roomCursorsKey(room), cursors, xx=True)
+            with redisLatency.time("ZADD"):
+                await pipe.execute()
+
+    async def trimMessages(self) -> List[str]:
+        with redisLatency.time("SMEMBERS"):
+            rooms = [room.decode() for room in await self.redisClient.smembers(ROOMS)]
+
+        async with self.redisClient.pipeline(transaction=False) as pipe:
+            for room in rooms:
+                pipe.zrange(roomCursorsKey(room), 0, 0, withscores=True)
+            with redisLatency.time("ZRANGE"):
+                oldestCursors = await pipe.execute()
+
+        async with self.redisClient.pipeline(transaction=False) as pipe:
+            for (room, oldestCursor) in zip(rooms, oldestCursors):
+                if len(oldestCursor) == 0:
+                    pipe.delete(roomMessagesKey(room))
+                    pipe.srem(ROOMS, room)
+                    continue
+
+                (_, lowWatermark) = oldestCursor[0]
+                pipe.zremrangebyscore(roomMessagesKey(room), min="-inf", max=lowWatermark)
+            with redisLatency.time("ZREMRANGEBYSCORE+DEL+SREM"):
+                results = iter(await pipe.execute())
+
+        trimmedRooms = []
+        for (room, oldestCursor) in zip(rooms, oldestCursors):
+            removed = next(results)
+            if len(oldestCursor) == 0:
+                next(results)
+            if removed:
+                trimmedRooms.append(room)
+
+        return trimmedRooms
+
+    async def publishNewMessage(self, announcement: str) -> None:
+        with redisLatency.time("PUBLISH"):
+            await self.redisClient.publish(NEW_MESSAGES_CHANNEL, announcement)
+
+    async def newMessages(self) -> AsyncIterator[bytes]:
+        pubsub = self.redisClient.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(NEW_MESSAGES_CHANNEL)
+        async for event in pubsub.listen():
+            yield event["data"]
+
+
+class _RoomLog:
+    """The messages and members of a room kept by MemoryStorage
+
+    Sequence ids have no gaps, so the messages are kept in an array where the position
+    of a message follows from its id. Messages are appended at the end and trimmed from
+    the front by moving start along, and the space before start is given back once it
+    is most of the array.
+    """
+
+    def __init__(self, firstSeq: int = 1, messages: List[bytes] = None):
+        self.messages: List[bytes] = [] if messages is None else messages
+        self.start = 0
+        # Sequence id of messages[start], or of the next message if there are none
+        self.firstSeq = firstSeq
+        # Fetch cursor of each member
+        self.cursors: Dict[str, int] = {}
+
+    @property
+    def lastSeq(self) -> int:
+        return self.firstSeq + len(self.messages) - self.start - 1
+
+    def append(self, details: str) -> int:
+        seq = self.lastSeq + 1
+        self.messages.append(storedMessage(seq, details))
+        return seq
+
+    def read(self, fromSeq: int) -> Tuple[List[int], List[bytes]]:
+        fromSeq = max(fromSeq, self.firstSeq)
+        messages = self.messages[self.start + fromSeq - self.firstSeq :]
+        return (list(range(fromSeq, fromSeq + len(messages))), messages)
+
+    def trim(self, upToSeq: int) -> bool:
+        """Removes the messages up to the given sequence id, returning whether there were any"""
+        count = min(upToSeq - self.firstSeq + 1, len(self.messages) - self.start)
+        if count <= 0:
+            return False
+
+        self.start += count
+        self.firstSeq += count
+        if self.start * 2 >= len(self.messages):
+            del self.messages[: self.start]
+            self.start = 0
+
+        return True
+
+
+class MemoryStorage(Storage):
+    """Keeps the chat in the memory of the server process
+
+    Every operation is a few dictionary and list operations, with no round trip to an
+    external service. Only a single server process can use it, so there is nobody to
+    announce new messages to. If snapshotPath is given, everything is saved to that
+    file every SNAPSHOT_INTERVAL seconds and when the storage is closed, and loaded
+    from it when the storage is made.
+    """
+
+    def __init__(self, snapshotPath: str = None):
+        self.snapshotPath = snapshotPath
+        # Details of each logged in user
+        self.sessions: Dict[str, str] = {}
+        self.userRooms: Dict[str, Set[str]] = {}
+        self.rooms: Dict[str, _RoomLog] = {}
+        # Sequence id of the last message of each room the clean up dropped, which the
+        # room goes on from if it is used again, like the sequence counter in redis
+        self.droppedRoomSeqs: Dict[str, int] = {}
+
+        if snapshotPath is not None and os.path.exists(snapshotPath):
+            self.loadSnapshot()
+
+    def roomLog(self, room: str) -> _RoomLog:
+        log = self.rooms.get(room)
+        if log is None:
+            log = _RoomLog(self.droppedRoomSeqs.pop(room, 0) + 1)
+            self.rooms[room] = log
+        return log
+
+    async def addSession(self, username: str, details: str, room: str) -> bool:
+        if username in self.sessions:
+            return False
+
+        self.sessions[username] = details
+        await self.addMember(room, username)
+        return True
+
+    async def hasSession(self, username: str) -> bool:
+        return username in self.sessions
+
+    async def removeSession(self, username: str) -> Tuple[bool, List[str]]:
+        removed = self.sessions.pop(username, None) is not None
+        rooms = list(self.userRooms.pop(username, ()))
+        for room in rooms:
+            self.roomLog(room).cursors.pop(username, None)
+
+        return (removed, rooms)
+
+    async def addMember(self, room: str, username: str) -> None:
+        log = self.roomLog(room)
+        log.cursors.setdefault(username, log.lastSeq)
+        self.userRooms.setdefault(username, set()).add(room)
+
+    async def removeMember(self, room: str, username: str) -> bool:
+        self.userRooms.get(username, set()).discard(room)
+        log = self.rooms.get(room)
+        return log is not None and log.cursors.pop(username, None) is not None
+
+    async def memberCursor(self, room: str, username: str) -> Tuple[bool, Optional[int]]:
+        log = self.rooms.get(room)
+        return (
+            username in self.sessions,
+            None if log is None else log.cursors.get(username),
+        )
+
+    async def appendMessage(self, room: str, details: str) -> int:
+        return self.roomLog(room).append(details)
+
+    async def readMessages(self, room: str, fromSeq: int) -> Tuple[List[int], List[bytes], int]:
+        log = self.rooms.get(room)
+        if log is None:
+            return ([], [], self.droppedRoomSeqs.get(room, 0))
+
+        return (*log.read(fromSeq), log.lastSeq)
+
+    async def readMemberMessages(
+        self, room: str, username: str, fromSeq: int
+    ) -> Tuple[bool, Optional[int], List[int], List[bytes], int]:
+        (authenticated, cursor) = await self.memberCursor(room, username)
+        return (authenticated, cursor, *await self.readMessages(room, fromSeq))
+
+    async def updateCursors(self, cursorsByRoom: Dict[str, Dict[str, int]]) -> None:
+        for (room, cursors) in cursorsByRoom.items():
+            log = self.rooms.get(room)
+            if log is None:
+                continue
+
+            for (username, cursor) in cursors.items():
+                if username in log.cursors:
+                    log.cursors[username] = cursor
+
+    async def trimMessages(self) -> List[str]:
+        trimmedRooms = []
+        for (room, log) in list(self.rooms.items()):
+            if len(log.cursors) == 0:
+                lowWatermark = log.lastSeq
+            else:
+                lowWatermark = min(log.cursors.values())
+
+            if log.trim(lowWatermark):
+                trimmedRooms.append(room)
+
+            # A room with no members left is dropped, keeping only its last sequence id
+            if len(log.cursors) == 0:
+                del self.rooms[room]
+                self.droppedRoomSeqs[room] = log.lastSeq
+
+        return trimmedRooms
+
+    async def run(self) -> None:
+        """Saves the snapshot every SNAPSHOT_INTERVAL seconds"""
+        if self.snapshotPath is None:
+            return
+
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            try:
+                await self.saveSnapshot()
+            except Exception:
+                traceback.print_exc()
+
+    async def close(self) -> None:
+        if self.snapshotPath is not None:
+            await self.saveSnapshot()
+
+    async def saveSnapshot(self) -> None:
+        """Saves everything to the snapshot file
+
+        The snapshot is taken at once, and written to the file on a worker thread. The
+        file is replaced in one step, so a crash while writing keeps the previous one.
+        """
+        snapshot = json.dumps(
+            {
+                "sessions": self.sessions,
+                "userRooms": {username: list(rooms) for (username, rooms) in self.userRooms.items()},
+                "rooms": {
+                    room: {
+                        "firstSeq": log.firstSeq,
+                        "messages": [message.decode() for message in log.messages[log.start :]],
+                        "cursors": log.cursors,
+                    }
+                    for (room, log) in self.rooms.items()
+                },
+                "droppedRoomSeqs": self.droppedRoomSeqs,
+            }
+        )
+        await asyncio.get_running_loop().run_in_executor(None, self.writeSnapshot, snapshot)
+
+    def writeSnapshot(self, snapshot: str) -> None:
+        temporaryPath = self.snapshotPath + ".tmp"
+        with open(temporaryPath, "w") as snapshotFile:
+            snapshotFile.write(snapshot)
+        os.replace(temporaryPath, self.snapshotPath)
+
+    def loadSnapshot(self) -> None:
+        with open(self.snapshotPath) as snapshotFile:
+            snapshot = json.load(snapshotFile)
+
+        self.sessions = snapshot["sessions"]
+        self.userRooms = {
+            username: set(rooms) for (username, rooms) in snapshot["userRooms"].items()
+        }
+        for (room, details) in snapshot["rooms"].items():
+            log = _RoomLog(
+                details["firstSeq"], [message.encode() for message in details["messages"]]
+            )
+            log.cursors = details["cursors"]
+            self.rooms[room] = log
+        self.droppedRoomSeqs = snapshot.get("droppedRoomSeqs", {})
@@ -0,0 +1,262 @@
+import asyncio
+import time
+import unittest
+from unittest import mock
+from . import handlers
+from .handlers import (
+    FETCH_CACHE_MAX_AGE,
+    FetchCache,
+    MessageNotifier,
+    SessionCache,
+    Subscribers,
+)
+
+ROOM = "default"
+ADDRESS = ("127.0.0.1", 5000)
+
+
+class _FakeServer:
+    """Keeps the pushes instead of sending them, to settle them by hand"""
+
+    def __init__(self) -> None:
+        self.pushes: list[asyncio.Future] = []
+
+    def push(self, message: bytes, address) -> asyncio.Future:
+        delivery = asyncio.get_running_loop().create_future()
+        self.pushes.append(delivery)
+        return delivery
+
+
+class SubscribersTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.subscribers = Subscribers()
+        self.subscribers.server = _FakeServer()
+        self.subscribers.add(ROOM, "alice", ADDRESS)
+        self.cursors: list[int] = []
+
+    def publish(self, seq: int) -> asyncio.Future:
+        self.subscribers.publish(
+            ROOM, seq, b"push", lambda username, cursor: self.cursors.append(cursor)
+        )
+        return self.subscribers.server.pushes[-1]
+
+    async def settle(self) -> None:
+        # Done callbacks run on the next pass of the event loop
+        await asyncio.sleep(0)
+
+    async def test_cursor_stays_at_last_contiguous_acknowledged_push(self):
+        deliveries = [self.publish(seq) for seq in range(1, 5)]
+
+        deliveries[1].set_result(None)
+        deliveries[2].set_result(None)
+        await self.settle()
+        self.assertEqual(self.cursors, [])
+
+        deliveries[0].set_result(None)
+        await self.settle()
+        self.assertEqual(self.cursors, [3])
+
+        deliveries[3].set_exception(ConnectionError())
+        await self.settle()
+        self.assertEqual(self.cursors, [3])
+        self.assertNotIn(ROOM, self.subscribers.subscriptions)
+
+    async def test_failed_push_keeps_cursor_before_it(self):
+        deliveries = [self.publish(seq) for seq in range(1, 3)]
+
+        deliveries[0].set_exception(ConnectionError())
+        deliveries[1].set_result(None)
+        await self.settle()
+        self.assertEqual(self.cursors, [])
+
+
+class _FakeStorage:
+    """Serves the messages of each room from memory, counting the reads"""
+
+    def __init__(self, messageSize: int = 10) -> None:
+        self.messageSize = messageSize
+        self.lastSeqs: dict[str, int] = {}
+        self.reads: list[tuple[str, int]] = []
+
+    def post(self, room: str) -> None:
+        self.lastSeqs[room] = self.lastSeqs.get(room, 0) + 1
+
+    async def readMessages(self, room: str, fromSeq: int):
+        self.reads.append((room, fromSeq))
+        seqs = list(range(max(fromSeq, 1), self.lastSeqs.get(room, 0) + 1))
+        return (seqs, [b"m" * self.messageSize for _ in seqs], self.lastSeqs.get(room, 0))
+
+
+class FetchCacheTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.notifier = MessageNotifier()
+        patcher = mock.patch.object(handlers, "messageNotifier", self.notifier)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage = _FakeStorage()
+
+    async def fetch(self, cache: FetchCache, room: str, afterSeq: int = 0):
+        return await cache.messagesAfter(
+            self.storage, room, self.notifier.version(room), afterSeq
+        )
+
+    async def test_requests_in_a_bucket_share_a_read(self):
+        cache = FetchCache(bucketSize=4)
+        for _ in range(3):
+            self.storage.post(ROOM)
+
+        self.assertEqual(await self.fetch(cache, ROOM, 0), ([b"m" * 10] * 3, 3))
+        self.assertEqual(await self.fetch(cache, ROOM, 2), ([b"m" * 10], 3))
+        self.assertEqual(await self.fetch(cache, ROOM, 3), ([], 3))
+        self.assertEqual(self.storage.reads, [(ROOM, 0)])
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    async def test_least_recently_used_entries_are_evicted_by_bytes(self):
+        # Room to cache two rooms of one 10 byte message each
+        cache = FetchCache(maxBytes=25)
+        for room in ["a", "b", "c"]:
+            self.storage.post(room)
+
+        await self.fetch(cache, "a")
+        await self.fetch(cache, "b")
+        await self.fetch(cache, "a")
+        await self.fetch(cache, "c")
+
+        self.assertEqual([key[0] for key in cache.entries], ["a", "c"])
+        self.assertEqual(cache.totalBytes, 20)
+        self.assertEqual(cache.evictions, 1)
+        self.assertNotIn("b", cache.roomEntries)
+
+        await self.fetch(cache, "b")
+        self.assertEqual([room for (room, _) in self.storage.reads], ["a", "b", "c", "b"])
+
+    async def test_entry_larger_than_the_cache_is_not_kept(self):
+        cache = FetchCache(maxBytes=5)
+        self.storage.post(ROOM)
+
+        self.assertEqual(await self.fetch(cache, ROOM), ([b"m" * 10], 1))
+        self.assertEqual(len(cache.entries), 0)
+
+    async def test_entries_are_not_used_after_max_age(self):
+        cache = FetchCache()
+        self.storage.post(ROOM)
+        await self.fetch(cache, ROOM)
+
+        (key, entry) = next(iter(cache.entries.items()))
+        (seqs, messages, size, _, lastSeq) = entry
+        readAt = time.monotonic() - FETCH_CACHE_MAX_AGE
+        cache.entries[key] = (seqs, messages, size, readAt + 1, lastSeq)
+        await self.fetch(cache, ROOM)
+        self.assertEqual(len(self.storage.reads), 1)
+
+        cache.entries[key] = (seqs, messages, size, readAt - 1, lastSeq)
+        await self.fetch(cache, ROOM)
+        self.assertEqual(len(self.storage.reads), 2)
+
+    async def test_new_version_reads_the_messages_again(self):
+        cache = FetchCache()
+        self.storage.post(ROOM)
+        self.assertEqual(await self.fetch(cache, ROOM), ([b"m" * 10], 1))
+
+        self.storage.post(ROOM)
+        await self.notifier.notify(ROOM)
+        self.assertEqual(await self.fetch(cache, ROOM), ([b"m" * 10] * 2, 2))
+        self.assertEqual(len(self.storage.reads), 2)
+
+    async def test_invalidate_drops_the_entries_of_the_room(self):
+        cache = FetchCache(bucketSize=1)
+        for room in ["a", "a", "b"]:
+            self.storage.post(room)
+        await self.fetch(cache, "a", 0)
+        await self.fetch(cache, "a", 1)
+        await self.fetch(cache, "b", 0)
+
+        cache.invalidate("a")
+        self.assertEqual([key[0] for key in cache.entries], ["b"])
+        self.assertEqual(cache.totalBytes, 10)
+        self.assertNotIn("a", cache.roomEntries)
+
+    async def test_entry_read_while_the_room_moves_on_is_not_kept(self):
+        cache = FetchCache()
+        self.storage.post(ROOM)
+        version = self.notifier.version(ROOM)
+        await self.notifier.notify(ROOM)
+
+        self.assertEqual(
+            await cache.messagesAfter(self.storage, ROOM, version, 0), ([b"m" * 10], 1)
+        )
+        self.assertEqual(len(cache.entries), 0)
+
+
+class SessionCacheTests(unittest.TestCase):
+    def test_add_and_remove(self):
+        cache = SessionCache()
+        self.assertFalse(cache.contains("alice"))
+
+        cache.add("alice")
+        cache.add((ROOM, "alice"))
+        self.assertTrue(cache.contains("alice"))
+        self.assertTrue(cache.contains((ROOM, "alice")))
+
+        cache.remove("alice")
+        self.assertFalse(cache.contains("alice"))
+        self.assertTrue(cache.contains((ROOM, "alice")))
+
+    def test_entries_expire_after_ttl(self):
+        cache = SessionCache(ttl=5)
+        cache.add("alice")
+        self.assertGreater(cache.sessions["alice"], time.monotonic() + 4)
+
+        cache.sessions["alice"] = time.monotonic() - 1
+        self.assertFalse(cache.contains("alice"))
+        self.assertNotIn("alice", cache.sessions)
+
+
+class MessageNotifierTests(unittest.IsolatedAsyncioTestCase):
+    async def test_notify_wakes_up_the_requests_waiting_on_the_room(self):
+        notifier = MessageNotifier()
+        waiters = {
+            room: asyncio.create_task(notifier.wait(room, notifier.version(room), 5))
+            for room in ["a", "b"]
+        }
+        await asyncio.sleep(0)
+
+        await notifier.notify("a")
+        self.assertTrue(await waiters["a"])
+        self.assertFalse(waiters["b"].done())
+        self.assertEqual(notifier.version("a"), 1)
+        self.assertEqual(notifier.version("b"), 0)
+
+        await notifier.notify("b")
+        self.assertTrue(await waiters["b"])
+
+    async def test_message_before_the_wait_is_not_missed(self):
+        notifier = MessageNotifier()
+        version = notifier.version(ROOM)
+        await notifier.notify(ROOM)
+
+        self.assertTrue(await notifier.wait(ROOM, version, 5))
+
+    async def test_wait_times_out(self):
+        notifier = MessageNotifier()
+        self.assertFalse(await notifier.wait(ROOM, notifier.version(ROOM), 0.01))
+
+    async def test_conditions_are_dropped_when_no_request_waits(self):
+        notifier = MessageNotifier()
+        waiters = [
+            asyncio.create_task(notifier.wait(ROOM, notifier.version(ROOM), 5)) for _ in range(2)
+        ]
+        await asyncio.sleep(0)
+        self.assertEqual(notifier.waiting, {ROOM: 2})
+
+        await notifier.notify(ROOM)
+        await asyncio.gather(*waiters)
+        self.assertEqual(notifier.conditions, {})
+        self.assertEqual(notifier.waiting, {})
+
+        await notifier.wait(ROOM, notifier.version(ROOM), 0.01)
+        self.assertEqual(notifier.conditions, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
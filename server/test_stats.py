@@ -0,0 +1,43 @@
+import math
+import random
+import unittest
+from .stats import SUB_BUCKET_BITS, LatencyHistogram
+
+# A percentile is reported as the highest latency of its bucket, which is off by at
+# most this fraction of the latencies in the bucket
+MAX_ERROR = 2 ** -SUB_BUCKET_BITS
+
+
+class LatencyHistogramTests(unittest.TestCase):
+    def assertWithinError(self, reported: int, micros: int):
+        self.assertGreaterEqual(reported, micros)
+        self.assertLessEqual(reported, micros * (1 + MAX_ERROR))
+
+    def test_percentile_error_across_powers_of_two(self):
+        for power in range(25):
+            for micros in [2 ** power - 1, 2 ** power, 2 ** power + 1, 3 * 2 ** power]:
+                histogram = LatencyHistogram()
+                # Half a microsecond more, so the conversion does not round down
+                histogram.record((micros + 0.5) / 1_000_000)
+                # A longer latency, so the percentile is not capped by the maximum
+                histogram.record(2 ** 30 / 1_000_000)
+                with self.subTest(micros=micros):
+                    self.assertWithinError(histogram.percentile(50), micros)
+
+    def test_percentiles_of_mixed_latencies(self):
+        latencies = sorted(random.Random(1).randrange(1, 2 ** 24) for _ in range(1000))
+        histogram = LatencyHistogram()
+        for micros in latencies:
+            histogram.record((micros + 0.5) / 1_000_000)
+
+        for percentile in [50, 90, 99, 99.9]:
+            with self.subTest(percentile=percentile):
+                micros = latencies[max(math.ceil(percentile / 100 * len(latencies)), 1) - 1]
+                self.assertWithinError(histogram.percentile(percentile), micros)
+
+    def test_empty(self):
+        self.assertEqual(LatencyHistogram().percentile(99), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
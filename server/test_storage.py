@@ -0,0 +1,160 @@
+import json
+import os
+import tempfile
+import unittest
+from .storage import MemoryStorage, RedisStorage, storedMessage
+
+try:
+    from fakeredis.aioredis import FakeRedis
+except ImportError:
+    FakeRedis = None
+
+ROOM = "default"
+
+
+def details(text: str) -> str:
+    return json.dumps({"username": "alice", "message": text, "timestamp": 1.0})
+
+
+class _StorageTests:
+    """Tests every storage passes, run by a subclass for each kind of storage"""
+
+    def makeStorage(self):
+        raise NotImplementedError()
+
+    async def asyncSetUp(self):
+        self.storage = self.makeStorage()
+
+    async def test_sessions(self):
+        self.assertFalse(await self.storage.hasSession("alice"))
+
+        self.assertTrue(await self.storage.addSession("alice", "{}", ROOM))
+        self.assertFalse(await self.storage.addSession("alice", "{}", ROOM))
+        self.assertTrue(await self.storage.hasSession("alice"))
+        self.assertEqual(await self.storage.memberCursor(ROOM, "alice"), (True, 0))
+
+    async def test_remove_session_leaves_every_room(self):
+        await self.storage.addSession("alice", "{}", ROOM)
+        await self.storage.addMember("other", "alice")
+
+        (removed, rooms) = await self.storage.removeSession("alice")
+        self.assertTrue(removed)
+        self.assertEqual(sorted(rooms), [ROOM, "other"])
+        self.assertFalse(await self.storage.hasSession("alice"))
+        self.assertEqual(await self.storage.memberCursor(ROOM, "alice"), (False, None))
+        self.assertEqual(await self.storage.memberCursor("other", "alice"), (False, None))
+
+        self.assertEqual(await self.storage.removeSession("alice"), (False, []))
+
+    async def test_append_and_read_by_seq(self):
+        for (expectedSeq, text) in enumerate(["one", "two", "three"], 1):
+            self.assertEqual(await self.storage.appendMessage(ROOM, details(text)), expectedSeq)
+        self.assertEqual(await self.storage.appendMessage("other", details("four")), 1)
+
+        self.assertEqual(
+            await self.storage.readMessages(ROOM, 2),
+            ([2, 3], [storedMessage(2, details("two")), storedMessage(3, details("three"))], 3),
+        )
+        self.assertEqual(json.loads(storedMessage(2, details("two")))["seq"], 2)
+        self.assertEqual(await self.storage.readMessages(ROOM, 4), ([], [], 3))
+        self.assertEqual(await self.storage.readMessages("empty", 0), ([], [], 0))
+
+    async def test_read_member_messages(self):
+        await self.storage.appendMessage(ROOM, details("one"))
+        await self.storage.addSession("alice", "{}", ROOM)
+        await self.storage.appendMessage(ROOM, details("two"))
+
+        self.assertEqual(
+            await self.storage.readMemberMessages(ROOM, "alice", 2),
+            (True, 1, [2], [storedMessage(2, details("two"))], 2),
+        )
+        self.assertEqual(
+            await self.storage.readMemberMessages(ROOM, "bob", 3), (False, None, [], [], 2)
+        )
+
+    async def test_cursors(self):
+        await self.storage.appendMessage(ROOM, details("one"))
+        await self.storage.addSession("alice", "{}", ROOM)
+        self.assertEqual(await self.storage.memberCursor(ROOM, "alice"), (True, 1))
+
+        await self.storage.appendMessage(ROOM, details("two"))
+        await self.storage.updateCursors({ROOM: {"alice": 2, "bob": 2}})
+        self.assertEqual(await self.storage.memberCursor(ROOM, "alice"), (True, 2))
+        # Cursors of users that are not members are not written
+        self.assertEqual(await self.storage.memberCursor(ROOM, "bob"), (False, None))
+
+        # Joining again keeps the cursor
+        await self.storage.appendMessage(ROOM, details("three"))
+        await self.storage.addMember(ROOM, "alice")
+        self.assertEqual(await self.storage.memberCursor(ROOM, "alice"), (True, 2))
+
+        self.assertTrue(await self.storage.removeMember(ROOM, "alice"))
+        self.assertFalse(await self.storage.removeMember(ROOM, "alice"))
+        self.assertEqual(await self.storage.memberCursor(ROOM, "alice"), (True, None))
+
+    async def test_trim_up_to_the_oldest_cursor(self):
+        await self.storage.addSession("alice", "{}", ROOM)
+        await self.storage.addSession("bob", "{}", ROOM)
+        for text in ["one", "two", "three"]:
+            await self.storage.appendMessage(ROOM, details(text))
+        await self.storage.updateCursors({ROOM: {"alice": 3, "bob": 1}})
+
+        self.assertEqual(await self.storage.trimMessages(), [ROOM])
+        self.assertEqual((await self.storage.readMessages(ROOM, 0))[0], [2, 3])
+        self.assertEqual(await self.storage.trimMessages(), [])
+
+    async def test_trim_drops_rooms_without_members(self):
+        await self.storage.addSession("alice", "{}", ROOM)
+        await self.storage.addMember("other", "alice")
+        await self.storage.appendMessage("other", details("one"))
+        await self.storage.appendMessage("other", details("two"))
+        await self.storage.removeMember("other", "alice")
+
+        self.assertEqual(await self.storage.trimMessages(), ["other"])
+        self.assertEqual(await self.storage.readMessages("other", 0), ([], [], 2))
+
+        # The sequence ids of the room go on from where they were
+        await self.storage.addMember("other", "alice")
+        self.assertEqual(await self.storage.memberCursor("other", "alice"), (True, 2))
+        self.assertEqual(await self.storage.appendMessage("other", details("three")), 3)
+
+
+class MemoryStorageTests(_StorageTests, unittest.IsolatedAsyncioTestCase):
+    def makeStorage(self):
+        return MemoryStorage()
+
+    async def test_dropped_rooms_are_not_kept(self):
+        await self.storage.appendMessage("other", details("one"))
+        await self.storage.trimMessages()
+        self.assertNotIn("other", self.storage.rooms)
+
+    async def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "snapshot.json")
+            storage = MemoryStorage(path)
+            await storage.addSession("alice", "{}", ROOM)
+            await storage.appendMessage(ROOM, details("one"))
+            await storage.appendMessage("other", details("two"))
+            await storage.trimMessages()
+            await storage.close()
+
+            loaded = MemoryStorage(path)
+            self.assertEqual(await loaded.memberCursor(ROOM, "alice"), (True, 0))
+            self.assertEqual(
+                await loaded.readMessages(ROOM, 0), ([1], [storedMessage(1, details("one"))], 1)
+            )
+            self.assertEqual(await loaded.appendMessage("other", details("three")), 2)
+
+
+@unittest.skipIf(FakeRedis is None, "fakeredis is not installed")
+class RedisStorageTests(_StorageTests, unittest.IsolatedAsyncioTestCase):
+    def makeStorage(self):
+        return RedisStorage(FakeRedis())
+
+    async def asyncTearDown(self):
+        await self.storage.redisClient.flushall()
+        await self.storage.redisClient.aclose()
+
+
+if __name__ == "__main__":
+    unittest.main()